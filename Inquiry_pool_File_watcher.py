@@ -15,30 +15,42 @@
     Avi Patil 1/5/2021
     Alter Sqs message to add file category
 
+    Secrets, the SQS client and the pyodbc/pytz/pysmb imports are loaded on first use rather than at import, to keep
+    cold starts short
+
 """
 import os 
 import logging
+import functools
 from datetime import datetime
 import boto3
 import json
-import pyodbc
-import pytz
 import re
-from smb.SMBConnection import SMBConnection
-from smb import smb_structs
+import lambda_metrics
 
 logger = logging.getLogger('custom_log_stat')
 logger.setLevel(logging.DEBUG)
-sqs = boto3.client('sqs', region_name = 'us-east-1')
-sqs_url =os.environ["IPFilePathQueue_URL"]
-secret_man= boto3.client('secretsmanager')
-response= secret_man.get_secret_value(SecretId = 'panto-user-secrets')
-secretDict= json.loads(response['SecretString'])
+
+
+@functools.lru_cache(maxsize=1)
+def get_secrets():
+    
+    secret_man= boto3.client('secretsmanager')
+    response= secret_man.get_secret_value(SecretId = 'panto-user-secrets')
+    return json.loads(response['SecretString'])
+
+
+@functools.lru_cache(maxsize=1)
+def get_sqs():
+    
+    return boto3.client('sqs', region_name = 'us-east-1'), os.environ["IPFilePathQueue_URL"]
 
 
 def get_smb_connection():
     
+    from smb.SMBConnection import SMBConnection
     try:
+        secretDict = get_secrets()
         username = secretDict['Zenaida_username']
         password = secretDict['Zenaida_pwd']
         domain = secretDict['Zenaida_domain']
@@ -119,8 +131,9 @@ def all_files_till_date(file_list,path,logged_date_dt_obj,conn,dict_1):
     
 def connect_SQL_server():
     
+    import pyodbc
     try:
-        conn = pyodbc.connect(secretDict['osprey_conn_string'])
+        conn = pyodbc.connect(get_secrets()['osprey_conn_string'])
         logger.info("Connection to MSSQL Osprey Server Successful")    
         return conn
     
@@ -140,12 +153,14 @@ def isempty(list_1):
     
 def convtoUTC(date_obj):
     
+    import pytz
     local_time = pytz.timezone("America/New_York")
     local_datetime = local_time.localize(date_obj, is_dst = is_daylightsaving(date_obj))
     utc_datetime = local_datetime.astimezone(pytz.utc)
     return  utc_datetime 
 
 def is_daylightsaving(date_obj):
+    import pytz
     x = datetime(datetime.now().year, 1, 1, 0, 0, 0, tzinfo=pytz.timezone('America/New_York')) # Jan 1 of this year 
     if date_obj.utcoffset() == x.utcoffset():
         return False
@@ -155,16 +170,20 @@ def is_daylightsaving(date_obj):
 
 def make_UTC_aware(date_obj):
     
+    import pytz
     utc_time = pytz.timezone("UTC")
     utc_datetime = utc_time.localize(date_obj, is_dst = None)
     return  utc_datetime
          
 
+@lambda_metrics.instrument('Inquiry_pool_File_watcher')
 def main(event=None, context= None):
     
+    from smb import smb_structs
     mssql_osprey_conn = connect_SQL_server()
-    zenaida2_conn = get_smb_connection()
-    cur= mssql_osprey_conn.cursor()
+    zenaida2_conn = lambda_metrics.track(get_smb_connection(), 'SMB', ('listPath', 'getAttributes'))
+    sqs, sqs_url = get_sqs()
+    cur= lambda_metrics.track(mssql_osprey_conn.cursor(), 'SQL', ('execute',))
     cur.execute("""SELECT enrollment_schedule_id FROM dw_dbo.Panto_inquiry_file_log with (nolock) order by enrollment_schedule_id  """)
     logged_rows = cur.fetchall()
     list_logged_schedule_id = [i[0] for i in logged_rows]
@@ -0,0 +1,166 @@
+""" AIMD concurrency control for the I/O bound stages.
+
+An AdaptiveConcurrency keeps a limit on how many operations of one stage are in flight and adjusts it the way TCP
+adjusts its window: every operation that completes in good time adds 1/limit (so +1 per full window), and a throttle,
+an error or a latency above latency_tolerance x the best latency seen multiplies it by `backoff`, at most
+once per smoothed latency so one burst of congestion is answered once.
+
+The latency signal only means something when operations are alike, e.g. S3 reads and copies of contact files. Where
+one operation's time depends on the size of its item - a tenant's record count and quota waits, a file's size -
+a big item would read as congestion and halve the window, so those stages pass latency_tolerance=None: the limit
+then only grows up to the hard cap and backs off on throttles and errors.
+
+The limit always stays within [minimum, maximum]: maximum is the stage's hard cap, e.g. the S3 connection pool or
+SFTP_MAX_CHANNELS. Rate quotas such as the YouVisit 100 requests/minute stay with their RateLimiter. With a
+Lambda context, nothing new is started once the remaining time drops below reserve_seconds plus the smoothed latency,
+so work is handed back (left in the inbox, returned as a batch item failure) rather than cut off by the timeout.
+
+    controller = AdaptiveConcurrency('delivery-read', maximum=32, context=context)
+    for (result, error) in controller.map(read, keys):
+        ...
+
+"""
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+OK = 'ok'
+THROTTLED = 'throttled'
+ERROR = 'error'
+
+THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                  'TooManyRequestsException', 'ProvisionedThroughputExceededException', 'RequestThrottled'}
+
+
+class TimeBudgetExceeded(Exception):
+    """Raised instead of starting an operation the remaining Lambda time cannot cover"""
+
+
+def classify_exception(error):
+    """THROTTLED for AWS throttling codes and HTTP 429, otherwise ERROR"""
+
+    # botocore ClientError carries a parsed response dict, requests' HTTPError the response object; errors rewrapped
+    # with str(e) (as the handlers do) only keep the message
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('Error', {}).get('Code')
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    else:
+        code, status = None, getattr(response, 'status_code', None)
+    message = str(error)
+    if code in THROTTLE_CODES or status == 429 or 'Too Many Requests' in message or 'SlowDown' in message:
+        return THROTTLED
+    return ERROR
+
+
+class AdaptiveConcurrency:
+
+    def __init__(self, name, maximum, minimum=1, initial=None, backoff=0.5, latency_tolerance=2.0, context=None,
+                 reserve_seconds=5.0, clock=time.monotonic):
+        self.name = name
+        self.maximum = max(minimum, maximum)
+        self.minimum = minimum
+        self.limit = float(min(self.maximum, initial or minimum))
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.context = context
+        self.reserve_seconds = reserve_seconds
+        self.clock = clock
+        self.latency = None
+        self.best_latency = None
+        self.last_decrease = None
+        self.in_flight = 0
+        self.completed = {OK: 0, THROTTLED: 0, ERROR: 0}
+        self.condition = threading.Condition()
+
+    @property
+    def window(self):
+        """Operations allowed in flight right now"""
+
+        return max(self.minimum, min(self.maximum, int(self.limit)))
+
+    def remaining_seconds(self):
+        # Local runs pass no context (or a placeholder without the Lambda methods)
+        remaining = getattr(self.context, 'get_remaining_time_in_millis', None)
+        return math.inf if remaining is None else remaining() / 1000.0
+
+    def acquire(self):
+        """Wait for a slot; returns the start time to hand to release(). Raises TimeBudgetExceeded when the
+        remaining time cannot cover another operation"""
+
+        with self.condition:
+            while self.in_flight >= self.window:
+                self.condition.wait()
+            if self.remaining_seconds() < self.reserve_seconds + (self.latency or 0.0):
+                raise TimeBudgetExceeded(f"{self.name}: {self.remaining_seconds():.1f}s left, not starting more")
+            self.in_flight += 1
+        return self.clock()
+
+    def release(self, started, outcome=OK):
+        with self.condition:
+            self.in_flight -= 1
+            self.on_complete(self.clock() - started, outcome)
+            self.condition.notify_all()
+
+    def on_complete(self, latency, outcome=OK):
+        """Feed one completed operation into the limit (callers of acquire/release do not call this directly)"""
+
+        self.completed[outcome] += 1
+        slow = False
+        if outcome == OK:
+            # Only completed work sets the baseline: a throttle or an error usually comes back faster than a real call
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            # At the minimum window the stage adds no queueing of its own, so a lastingly slower service resets the
+            # baseline there instead of pinning the window at the minimum for good
+            if self.best_latency is None or self.window == self.minimum:
+                self.best_latency = latency
+            self.best_latency = min(self.best_latency, latency)
+            slow = self.latency_tolerance is not None and latency > self.best_latency * self.latency_tolerance
+
+        if outcome != OK or slow:
+            now = self.clock()
+            if self.last_decrease is None or now - self.last_decrease >= (self.latency or 0.0):
+                self.limit = max(float(self.minimum), self.limit * self.backoff)
+                self.last_decrease = now
+        else:
+            self.limit = min(float(self.maximum), self.limit + 1.0 / self.limit)
+
+    def map(self, fn, items, classify=None):
+        """Run fn over items with at most `window` in flight; returns [(result, exception)] in item order.
+
+        classify(result) names the outcome of a call that returned (default OK); a call that raised is classified by
+        classify_exception. Items not started because of the time budget get (None, TimeBudgetExceeded)."""
+
+        items = list(items)
+        outcomes = [None] * len(items)
+
+        def call(position, started):
+            outcome = OK
+            try:
+                result = fn(items[position])
+                outcome = classify(result) if classify else OK
+                outcomes[position] = (result, None)
+            except Exception as e:
+                outcome = classify_exception(e)
+                outcomes[position] = (None, e)
+            finally:
+                self.release(started, outcome)
+
+        with ThreadPoolExecutor(max_workers=self.maximum) as executor:
+            for position in range(len(items)):
+                try:
+                    started = self.acquire()
+                except TimeBudgetExceeded as e:
+                    logger.warning(f"{e} - {len(items) - position} of {len(items)} left")
+                    for rest in range(position, len(items)):
+                        outcomes[rest] = (None, e)
+                    break
+                executor.submit(call, position, started)
+
+        logger.info(f"{self.name}: window {self.window}, {self.completed[OK]} ok, {self.completed[THROTTLED]} "
+                    f"throttled, {self.completed[ERROR]} errors, latency {self.latency or 0.0:.3f}s")
+        return outcomes
@@ -0,0 +1,79 @@
+""" Import (cold start) cost of the lambda handlers, measured with python -X importtime.
+
+Each handler is imported in a fresh interpreter; the report gives the total import time and the heaviest modules it
+pulled in. test_import_time.py uses the same measurement to keep heavy, path dependent dependencies out of the
+handlers' import.
+
+    python bench_import_time.py --repeat 5 --top 10
+
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+HANDLERS = {
+    'Inquiry_pool_File_watcher': 'Inquiry_pool_File_watcher.py',
+    'delivery_scheduler': 'delivery_scheduler.py',
+    's3-sftp': 's3-sftp_1_9_2020.py',
+    'you_visit_api': 'you_visit_api.py',
+}
+
+MARKER = '-- import starts --'
+
+# Loads the file the way the Lambda runtime does, after writing a marker so interpreter startup is not counted
+IMPORT_SCRIPT = (
+    "import importlib.util, sys\n"
+    "spec = importlib.util.spec_from_file_location('handler', sys.argv[1])\n"
+    "module = importlib.util.module_from_spec(spec)\n"
+    f"sys.stderr.write({MARKER!r} + '\\n')\n"
+    "spec.loader.exec_module(module)\n"
+)
+
+
+def measure(file_name, env=None):
+    """Import file_name in a new interpreter; returns (total_us, {module: (self_us, cumulative_us)})"""
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', IMPORT_SCRIPT, os.path.join(HERE, file_name)],
+                            cwd=HERE, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {file_name} failed:\n{result.stderr}")
+
+    lines = result.stderr.splitlines()
+    modules = {}
+    total = 0
+    for line in lines[lines.index(MARKER) + 1:]:
+        if not line.startswith('import time:'):
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+        if not name[1:].startswith(' '):
+            # Top level import of the handler itself, not one nested below another
+            total += int(cumulative_us)
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='heaviest modules to list per handler')
+    args = parser.parse_args()
+
+    for handler, file_name in HANDLERS.items():
+        try:
+            runs = [measure(file_name) for _ in range(args.repeat)]
+        except RuntimeError as e:
+            print(f"{handler}: not measured - {str(e).splitlines()[-1]}")
+            continue
+        totals = [total for total, modules in runs]
+        print(f"{handler}: median {statistics.median(totals) / 1000:.1f} ms, {len(runs[0][1])} modules")
+        heaviest = sorted(runs[0][1].items(), key=lambda item: item[1][1], reverse=True)
+        for name, (self_us, cumulative_us) in heaviest[:args.top]:
+            print(f"    {cumulative_us / 1000:>8.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+""" MB/s benchmark of the S3 -> SFTP transfer against a local SFTP server.
+
+Compares the original path (download_fileobj into an unpipelined paramiko file on a default transport) with
+sftp_transfer (tuned transport, pipelined buffered writes, parallel ranged S3 GETs). S3 is served by moto and the
+SFTP side by LocalSFTPServer behind a proxy that adds --rtt-ms of round trip latency, which is where acknowledging
+every write one at a time costs throughput.
+
+    python bench_sftp_transfer.py --size-mb 64 --repeat 3 --rtt-ms 20
+
+"""
+import argparse
+import hashlib
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+import boto3
+import paramiko
+from moto import mock_aws
+
+import sftp_transfer
+from local_sftp_server import LocalSFTPServer
+
+USERNAME = 'nsc'
+PASSWORD = 'bench'
+
+
+class LatencyProxy:
+    """TCP forwarder on 127.0.0.1 that delays every chunk by half the round trip in each direction"""
+
+    def __init__(self, target_port, rtt_ms):
+        self.target_port = target_port
+        self.delay = rtt_ms / 2000.0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(('127.0.0.1', self.target_port))
+            for source, sink in ((client, upstream), (upstream, client)):
+                chunks = queue.Queue()
+                threading.Thread(target=self._read, args=(source, chunks), daemon=True).start()
+                threading.Thread(target=self._write, args=(sink, chunks), daemon=True).start()
+
+    def _read(self, source, chunks):
+        while True:
+            try:
+                data = source.recv(256 * 1024)
+            except OSError:
+                data = b''
+            chunks.put((time.monotonic() + self.delay, data))
+            if not data:
+                return
+
+    def _write(self, sink, chunks):
+        while True:
+            due, data = chunks.get()
+            wait = due - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                if not data:
+                    sink.shutdown(socket.SHUT_WR)
+                    return
+                sink.sendall(data)
+            except OSError:
+                return
+
+    def close(self):
+        self.sock.close()
+
+
+def baseline(endpoint, s3_client, bucket, key):
+    transport = paramiko.Transport(('127.0.0.1', endpoint.port))
+    transport.connect(username=USERNAME, password=PASSWORD)
+    try:
+        sftp_client = paramiko.SFTPClient.from_transport(transport)
+        with sftp_client.file(key, 'w') as sftp_file:
+            s3_client.download_fileobj(Bucket=bucket, Key=key, Fileobj=sftp_file)
+    finally:
+        transport.close()
+
+
+def tuned(endpoint, s3_client, bucket, key):
+    transport = sftp_transfer.open_transport('127.0.0.1', endpoint.port, USERNAME, PASSWORD)
+    try:
+        sftp_client = paramiko.SFTPClient.from_transport(transport)
+        with sftp_transfer.open_remote(sftp_client, key) as sftp_file:
+            sftp_transfer.stream_s3_to_sftp(s3_client, bucket, key, sftp_file)
+    finally:
+        transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size-mb', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--rtt-ms', type=float, default=20.0, help='round trip latency added between client and server')
+    args = parser.parse_args()
+
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    root = tempfile.mkdtemp(prefix='bench_sftp_')
+    payload = os.urandom(args.size_mb * 1024 * 1024)
+    digest = hashlib.md5(payload).hexdigest()
+
+    try:
+        with mock_aws(), LocalSFTPServer(root, USERNAME, PASSWORD, window_size=sftp_transfer.SFTP_WINDOW_SIZE,
+                                         max_packet_size=sftp_transfer.SFTP_MAX_PACKET_SIZE) as server:
+            proxy = LatencyProxy(server.port, args.rtt_ms)
+            s3_client = boto3.client('s3', region_name='us-east-1')
+            s3_client.create_bucket(Bucket='nsc-bench')
+            s3_client.put_object(Bucket='nsc-bench', Key='clearinghouse.dat', Body=payload)
+
+            print(f"{'engine':>10} {'run':>4} {'seconds':>9} {'MB/s':>8}")
+            for name, engine in (('baseline', baseline), ('tuned', tuned)):
+                for run in range(args.repeat):
+                    started = time.perf_counter()
+                    engine(proxy, s3_client, 'nsc-bench', 'clearinghouse.dat')
+                    elapsed = time.perf_counter() - started
+                    with open(os.path.join(root, 'clearinghouse.dat'), 'rb') as written:
+                        if hashlib.md5(written.read()).hexdigest() != digest:
+                            raise Exception(f'{name} wrote a file that does not match the S3 object')
+                    print(f"{name:>10} {run:>4} {elapsed:>9.2f} {args.size_mb / elapsed:>8.1f}")
+            proxy.close()
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
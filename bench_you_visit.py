@@ -0,0 +1,74 @@
+""" Throughput benchmark for the YouVisit puller against the local simulator.
+
+Each tenant size is pulled through you_visit_api.run_tenant (recon -> pull_data -> csv_export) with the process log
+served by FakePantoDatabase and the API by YouVisitSimulator, and the run reports records/sec, API calls and the
+peak traced memory per tenant size.
+
+    python bench_you_visit.py --sizes 500 5000 50000 --rpm 100
+
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import you_visit_api
+from you_visit_simulator import TenantSpec, YouVisitSimulator, FakePantoDatabase
+
+
+def bench_tenant(size, rpm, error_rate, key_sets, linefeed_rate):
+    """Pull one tenant of `size` records; returns a dict of measurements"""
+
+    tenant_guid = f"bench-{size}"
+    member_sk = str(size)
+    create_date_time = '2021-01-01 06:00:00'
+    spec = TenantSpec(tenant_guid, size, key_sets=key_sets, linefeed_rate=linefeed_rate, error_rate=error_rate)
+
+    database = FakePantoDatabase()
+    database.launch(member_sk, create_date_time)
+    process_log = you_visit_api.ProcessLog(database.connect())
+    you_visit_api.api_rate_limiter = you_visit_api.RateLimiter(rpm)
+
+    with YouVisitSimulator([spec], requests_per_minute=rpm) as simulator:
+        body = f"00000|token|{simulator.url_for(tenant_guid)}|{create_date_time}|{tenant_guid}|{member_sk}"
+        run = you_visit_api.parse_message(body)
+
+        tracemalloc.start()
+        started = time.perf_counter()
+        start_point = process_log.start_points([run])[run]
+        you_visit_api.run_tenant(run, process_log, start_point)
+        process_log.flush()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        row = database.status_of(member_sk, create_date_time)
+        records = max(len(run.output_buffer) - 1, 0)
+        return {'size': size, 'status': row['status_indicator'], 'records': records, 'seconds': elapsed,
+                'records_per_sec': records / elapsed if elapsed else 0.0,
+                'api_calls': sum(simulator.api_calls.values()), 'peak_mb': peak / (1024 * 1024)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[500, 5000, 20000])
+    parser.add_argument('--rpm', type=int, default=100, help='API throttle, requests per minute')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of calls answered with 429/5xx')
+    parser.add_argument('--key-sets', type=int, default=3)
+    parser.add_argument('--linefeed-rate', type=float, default=0.01)
+    args = parser.parse_args()
+
+    # Files are written locally rather than pushed to S3
+    you_visit_api.in_aws = False
+    os.chdir(tempfile.mkdtemp(prefix='bench_you_visit_'))
+
+    print(f"{'size':>8} {'status':>22} {'records':>8} {'seconds':>9} {'rec/s':>10} {'api calls':>9} {'peak MB':>8}")
+    for size in args.sizes:
+        result = bench_tenant(size, args.rpm, args.error_rate, args.key_sets, args.linefeed_rate)
+        print(f"{result['size']:>8} {result['status']:>22} {result['records']:>8} {result['seconds']:>9.2f} "
+              f"{result['records_per_sec']:>10.1f} {result['api_calls']:>9} {result['peak_mb']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
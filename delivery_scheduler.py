@@ -9,16 +9,22 @@ Avi Patil / apatil@eab.com / 2021-02-21
 Make change to use smart_open for writing files to s3
 Avi Patil / apatil@eab.com / 2021-03-12
 
+S3 access goes through the shared, tuned client in s3_io
+
+Contacts are read and moved in parallel, as many at a time as S3 keeps up with - see adaptive_concurrency. Contacts
+that cannot be read before the Lambda runs out of time are left in the inbox for the next run; contacts that were
+written are always moved.
+
 """
 import os
-import boto3
 import logging
 import csv
-import json
 import datetime
 from datetime import timezone, timedelta
 import io
-from smart_open import open, s3
+import adaptive_concurrency
+import lambda_metrics
+import s3_io
 
 
 logger = logging.getLogger('custom_log_stat')
@@ -26,10 +32,8 @@ logger.setLevel(logging.DEBUG)
 
 
 def s3_objects_config():
-    """Define S3 Objects"""
-    s3_obj = boto3.client('s3')
-    s3_connection = boto3.resource('s3', region_name='us-east-1')
-    return s3_obj, s3_connection
+    """Define S3 Object - the shared s3_io client"""
+    return s3_io.client()
 
 
 def strip_file_path(source_list):
@@ -45,39 +49,45 @@ def strip_file_path(source_list):
     return new_list
 
 
-def move_file_s3(bucket_name, file_list, partner_id, s3_connection):
+def s3_concurrency(name, context=None):
+    """AIMD limit on the S3 calls of one kind in flight, capped by the client's connection pool"""
+    return adaptive_concurrency.AdaptiveConcurrency(name, maximum=s3_io.S3_MAX_POOL_CONNECTIONS, initial=4,
+                                                    context=context)
+
+
+def move_file_s3(bucket_name, file_list, partner_id, concurrency=None):
     """Move files to Outbox folder after writing to csv is complete"""
 
     generalized_file_path_list = strip_file_path(file_list.copy())  # Strip inbox from inbox/partner-444/xyz.json
-    for file_path in generalized_file_path_list:
+
+    def move(file_path):
         src_file_path = 'inbox' + file_path
         # define new file path
         dest_file_path = 'outbox' + file_path
-        copy_source = {
-            'Bucket': bucket_name,
-            'Key': src_file_path
-        }
         try:
             # COPY file to outbox
-            s3_connection.meta.client.copy(copy_source, bucket_name, dest_file_path)
+            s3_io.copy(bucket_name, src_file_path, bucket_name, dest_file_path)
         except Exception as e:
             raise Exception(f'There was an error copying  file  {src_file_path}' + str(e))
 
         try:
             # delete file from inbox
-            s3_connection.Object(bucket_name, src_file_path).delete()
+            s3_io.delete(bucket_name, src_file_path)
         except Exception as e:
             raise Exception(f'There was an error deleting  file  {src_file_path}' + str(e))
 
+    # No time budget here: a contact that was written has to leave the inbox
+    concurrency = concurrency or s3_concurrency('delivery_scheduler moves')
+    for result, error in concurrency.map(move, generalized_file_path_list):
+        if error is not None:
+            raise error
+
 
-def read_json(bucket_name, key_name, s3):
+def read_json(bucket_name, key_name):
     """Read Json contacts in a python dictionary"""
 
     try:
-        result = s3.get_object(Bucket=bucket_name, Key=key_name)
-        content = result['Body']
-        json_dict = json.loads(content.read().decode('utf-8'))
-        return json_dict
+        return s3_io.read_json(bucket_name, key_name)
 
     except Exception as e:
         raise Exception(f'There was an error while reading the json file {key_name}' + str(e))
@@ -123,11 +133,10 @@ def write_to_csv(output_b, bucket_name, file_name, key_path):
         original_file_name = file_name
         key = f"{key_path}/{original_file_name}"
 
-        # 's3://commoncrawl/robots.txt' is syntax to be passed to open
         path_to_open_file = 's3://' + bucket_name + '/' + key
         logger.info(f'file path is{path_to_open_file}')
 
-        with open(path_to_open_file, mode='w', encoding='utf-8') as file_out:
+        with s3_io.open_s3(bucket_name, key, mode='w', encoding='utf-8') as file_out:
             output_writer = csv.writer(f, delimiter="|", quotechar='"', quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
 
             for row in output_b:
@@ -204,13 +213,14 @@ def calculate_sub_file_list(all_partner_file_list, partner_id):
         raise Exception('Issue in calculating a sub list' + str(e))
 
 
+@lambda_metrics.instrument('delivery_scheduler')
 def main(event, context):
 
     partner_id_list = []
     file_list = []
     bucket_name = os.environ['SourceBucket']
     bucket_name_destination = os.environ['DestinationBucket']
-    s3_obj, s3_connection = s3_objects_config()
+    s3_obj = s3_objects_config()
 
     for key in get_matching_s3_keys(s3_obj, bucket=bucket_name, prefix='inbox/partner', suffix='.json'):
         partner_id_list.append(calc_list_partner_id(key))
@@ -221,6 +231,8 @@ def main(event, context):
         return 0
 
     partner_id_list = list(set(partner_id_list))  # dedupe the list
+    reads = s3_concurrency('delivery_scheduler reads', context)
+    moves = s3_concurrency('delivery_scheduler moves')
     logger.info(f'partners identified with files {partner_id_list}')
 
     """ 
@@ -238,8 +250,19 @@ def main(event, context):
         header_flag = 0
         current_time = get_observation_timestamp()
 
-        for partner_json_contact in partner_file_list:
-            content_dict = read_json(bucket_name, partner_json_contact, s3_obj)
+        contents = reads.map(lambda key: read_json(bucket_name, key), partner_file_list)
+        for result, error in contents:
+            if error is not None and not isinstance(error, adaptive_concurrency.TimeBudgetExceeded):
+                raise error
+        # Out of time: only the contacts read so far are written and moved, the rest wait for the next run
+        partner_file_list = [key for key, (result, error) in zip(partner_file_list, contents) if error is None]
+        if not partner_file_list:
+            logger.warning(f'No time left to read the contacts of {partner_id}, leaving them in the inbox')
+            continue
+
+        for content_dict, error in contents:
+            if error is not None:
+                continue
 
             if header_flag == 0:
                 header_list = calc_header_list(content_dict)
@@ -257,5 +280,5 @@ def main(event, context):
 
         logger.info(f'{len(partner_file_list)} contact files for {partner_id} successfully written to '
                     f'{partner_file_name}')
-        move_file_s3(bucket_name, partner_file_list, partner_id, s3_connection)
+        move_file_s3(bucket_name, partner_file_list, partner_id, moves)
         logger.info(f"Successfully Moved {len(partner_file_list)} json files for {partner_id} in outbox folder ")
@@ -0,0 +1,259 @@
+""" Common metrics and profiling for the lambda entry points.
+
+    @lambda_metrics.instrument('delivery_scheduler')
+    def main(event, context):
+
+Every invocation of an instrumented handler prints one CloudWatch embedded metric format (EMF) record to stdout, which
+CloudWatch Logs turns into metrics in METRICS_NAMESPACE with a Function dimension:
+
+    Latency             handler wall time, ms
+    MaxRSS              memory high-water mark of the process, MB
+    Error               1 when the handler raised (or exited), else 0
+    <KIND>Calls         external calls made, per kind: S3, SQS, SMB, SQL, HTTP, SFTP, ...
+    <KIND>Bytes         bytes moved by those calls
+    <KIND>Time          time spent in those calls, ms, summed over the threads making them
+
+AWS calls are counted by botocore hooks installed when this module is imported, on the default boto3 session and on
+every session created afterwards, so every client created after the import is covered. Other kinds are counted where the call is made, with record() or by wrapping
+a connection or cursor in track(). Both are no-ops outside an instrumented handler.
+
+With LAMBDA_PROFILE=cprofile (or pyinstrument, when it is packaged) the invocation is also profiled and the result
+uploaded to s3://LAMBDA_PROFILE_BUCKET/LAMBDA_PROFILE_PREFIX<function>/. Both profilers sample the handler's own
+thread only, so work done on pool threads shows up as time spent waiting on them.
+
+"""
+import functools
+import io
+import json
+import logging
+import os
+import resource
+import threading
+import time
+
+import boto3
+import botocore.handlers
+
+logger = logging.getLogger()
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'DataPipelines')
+LAMBDA_PROFILE = os.getenv('LAMBDA_PROFILE', '').lower()
+LAMBDA_PROFILE_BUCKET = os.getenv('LAMBDA_PROFILE_BUCKET', '')
+LAMBDA_PROFILE_PREFIX = os.getenv('LAMBDA_PROFILE_PREFIX', 'profiles/')
+
+AWS_KINDS = {'s3': 'S3', 'sqs': 'SQS'}
+
+_active = None
+_cold_start = True
+
+
+class Invocation:
+    """External calls and bytes recorded during one handler invocation; record() is thread safe"""
+
+    def __init__(self, function):
+        self.function = function
+        self.calls = {}
+        self.bytes = {}
+        self.seconds = {}
+        self.lock = threading.Lock()
+
+    def record(self, kind, nbytes=0, calls=1, seconds=0.0):
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + calls
+            self.bytes[kind] = self.bytes.get(kind, 0) + (nbytes or 0)
+            self.seconds[kind] = self.seconds.get(kind, 0.0) + seconds
+
+    def emf(self, latency_ms, error, cold_start):
+        """The invocation as one EMF record"""
+
+        values = {'Latency': (latency_ms, 'Milliseconds'),
+                  'MaxRSS': (max_rss_mb(), 'Megabytes'),
+                  'Error': (1 if error else 0, 'Count')}
+        with self.lock:
+            for kind in sorted(self.calls):
+                values[f"{kind}Calls"] = (self.calls[kind], 'Count')
+                values[f"{kind}Bytes"] = (self.bytes[kind], 'Bytes')
+                values[f"{kind}Time"] = (self.seconds[kind] * 1000.0, 'Milliseconds')
+
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [['Function']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (value, unit) in values.items()],
+                }],
+            },
+            'Function': self.function,
+            'ColdStart': cold_start,
+        }
+        record.update({name: value for name, (value, unit) in values.items()})
+        return record
+
+
+def max_rss_mb():
+    """Peak resident memory of the process (ru_maxrss is in KB on Linux)"""
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def record(kind, nbytes=0, calls=1, seconds=0.0):
+    """Count an external call (and the bytes it moved and the time it took) against the running handler, if any"""
+
+    invocation = _active
+    if invocation is not None:
+        invocation.record(kind, nbytes, calls, seconds)
+
+
+class track:
+    """Proxy for a connection or cursor that records one `kind` call per call of any of `methods`"""
+
+    def __init__(self, target, kind, methods):
+        self._target = target
+        self._kind = kind
+        self._methods = set(methods)
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if name not in self._methods:
+            return attribute
+
+        @functools.wraps(attribute)
+        def counted(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                record(self._kind, seconds=time.perf_counter() - started)
+        return counted
+
+
+def _body_size(body):
+    """Bytes a request will send; botocore hands over bytes, a sized chunk (multipart) or a seekable stream"""
+
+    if body is None:
+        return 0
+    if hasattr(body, '__len__'):
+        return len(body)
+    try:
+        position = body.tell()
+        end = body.seek(0, os.SEEK_END)
+        body.seek(position)
+        return end - position
+    except Exception:
+        return 0
+
+
+def _aws_kind(model):
+    return AWS_KINDS.get(model.service_model.service_name, model.service_model.service_name.upper())
+
+
+def _before_call(model=None, params=None, context=None, **kwargs):
+    kind = _aws_kind(model)
+    # botocore passes the same request context to the after-call events
+    if context is not None:
+        context['lambda_metrics'] = (kind, time.perf_counter())
+    record(kind, _body_size((params or {}).get('body')))
+
+
+def _after_call(model=None, parsed=None, context=None, **kwargs):
+    # The call itself was counted before it was made; add its time and, for a download, the bytes received
+    kind, started = (context or {}).get('lambda_metrics', (None, None))
+    if kind is None:
+        return
+    nbytes = 0
+    if model is not None and model.service_model.service_name == 's3' and model.name == 'GetObject' and parsed:
+        nbytes = parsed.get('ContentLength') or 0
+    record(kind, nbytes, calls=0, seconds=time.perf_counter() - started)
+
+
+def _install_aws_hooks():
+    # Sessions register BUILTIN_HANDLERS when they are created; the default session may already exist
+    hooks = [('before-call', _before_call), ('after-call', _after_call), ('after-call-error', _after_call)]
+    botocore.handlers.BUILTIN_HANDLERS.extend(hooks)
+    if boto3.DEFAULT_SESSION is not None:
+        for event, handler in hooks:
+            boto3.DEFAULT_SESSION.events.register(event, handler)
+
+
+_install_aws_hooks()
+
+
+def instrument(function):
+    """Decorator recording latency, external calls, bytes and memory of every invocation as EMF"""
+
+    def decorator(handler):
+
+        @functools.wraps(handler)
+        def wrapper(event=None, context=None):
+            global _active, _cold_start
+            invocation = Invocation(function)
+            cold_start, _cold_start = _cold_start, False
+            _active = invocation
+            profiler = start_profiler()
+            started = time.perf_counter()
+            error = True
+            try:
+                result = handler(event, context)
+                error = False
+                return result
+            finally:
+                latency_ms = (time.perf_counter() - started) * 1000.0
+                _active = None
+                print(json.dumps(invocation.emf(latency_ms, error, cold_start)), flush=True)
+                if profiler is not None:
+                    upload_profile(profiler, function, context)
+        return wrapper
+    return decorator
+
+
+def start_profiler():
+    """A running profiler when LAMBDA_PROFILE asks for one, else None"""
+
+    if not LAMBDA_PROFILE:
+        return None
+    if LAMBDA_PROFILE == 'pyinstrument':
+        try:
+            from pyinstrument import Profiler
+            profiler = Profiler()
+            profiler.start()
+            return profiler
+        except ImportError:
+            logger.warning("LAMBDA_PROFILE=pyinstrument but pyinstrument is not packaged, using cProfile")
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+
+def upload_profile(profiler, function, context):
+    """Stop the profiler and put its output in the profile bucket; a failed upload is only logged"""
+
+    request_id = getattr(context, 'aws_request_id', None) or 'local'
+    stamp = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+    try:
+        if hasattr(profiler, 'output_html'):
+            profiler.stop()
+            body, extension = profiler.output_html().encode('utf-8'), 'html'
+        else:
+            import marshal
+            profiler.disable()
+            profiler.create_stats()
+            body, extension = marshal.dumps(profiler.stats), 'prof'
+            logger.info(_top_functions(profiler))
+        if not LAMBDA_PROFILE_BUCKET:
+            logger.warning("LAMBDA_PROFILE is set but LAMBDA_PROFILE_BUCKET is not, profile not uploaded")
+            return
+        key = f"{LAMBDA_PROFILE_PREFIX}{function}/{stamp}-{request_id}.{extension}"
+        import s3_io
+        s3_io.client().put_object(Bucket=LAMBDA_PROFILE_BUCKET, Key=key, Body=body)
+        logger.info(f"Profile uploaded to s3://{LAMBDA_PROFILE_BUCKET}/{key}")
+    except Exception:
+        logger.exception("Unable to upload the profile")
+
+
+def _top_functions(profiler, limit=15):
+    import pstats
+    out = io.StringIO()
+    pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+    return out.getvalue()
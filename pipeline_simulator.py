@@ -0,0 +1,529 @@
+""" End-to-end local replay of the ingestion chain.
+
+Runs the real handlers against local stand-ins and reports where the time goes in every stage:
+
+    watcher        Inquiry_pool_File_watcher.main   FakeSMBTree (Zenaida), SQLite log tables (Osprey), moto SQS
+    you_visit      you_visit_api.main               moto SQS batches, YouVisitSimulator, FakePantoDatabase, moto S3
+    delivery       delivery_scheduler.main          moto S3 inbox/outbox/archive
+    s3_sftp        on_trigger_event                 moto S3 events, LocalSFTPServer (optionally behind --sftp-rtt-ms)
+
+A synthetic day is generated from BASE_DAY multiplied by each --scale. The watcher runs twice (most files land before
+the first run, the rest before the second, so both its insert and update paths are taken); the other stages run once
+over the day's input. Timings per external call come from the EMF record lambda_metrics prints for every invocation.
+The process runs in UTC like the Lambda runtime, and getdate() answers in New York time like the Osprey server.
+
+    python pipeline_simulator.py --scale 1 5 --api-rpm 100 --smb-latency-ms 5 --sftp-rtt-ms 20
+
+"""
+import argparse
+import contextlib
+import datetime
+import fnmatch
+import importlib.util
+import io
+import json
+import logging
+import os
+import posixpath
+import random
+import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+from unittest import mock
+from zoneinfo import ZoneInfo
+
+from moto import mock_aws
+from smb import smb_structs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Volume of one real day; --scale multiplies every count
+BASE_DAY = {
+    'schools': 40,
+    'files_per_school': 2,
+    'tenants': 20,
+    'leads_per_tenant': 300,
+    'partners': 15,
+    'contacts_per_partner': 120,
+    'clearinghouse_files': 20,
+    'clearinghouse_bytes': 256 * 1024,
+}
+
+# Share of the watcher's files that land before its first run of the day
+MORNING_SHARE = 0.8
+INVALID_PATH_RATE = 0.05
+
+SFTP_USERNAME = 'nsc'
+SFTP_PASSWORD = 'simulator'
+STAGES = ('watcher', 'you_visit', 'delivery', 's3_sftp')
+
+
+# -- Osprey SQL Server tables, in SQLite ---------------------------------------------------------------------------
+
+OSPREY_SCHEMA = """
+CREATE TABLE dbo.panto_ip_file_transfer (
+    enrollment_schedule_id INTEGER PRIMARY KEY, school_cd TEXT, school_name TEXT, ftp_path TEXT,
+    file_name_search_pattern TEXT, school_id TEXT, counter_ID__C TEXT, file_category TEXT, enrollment_type TEXT,
+    schedule_id INTEGER, RunDate TEXT);
+CREATE TABLE dw_dbo.Panto_inquiry_file_log (
+    enrollment_schedule_id INTEGER, school_cd TEXT, new_files_identified INTEGER, status_log TEXT, schedule_id INTEGER,
+    rec_create_dt TIMESTAMP, rec_update_dt TIMESTAMP);
+CREATE TRIGGER dw_dbo.panto_inquiry_file_log_created AFTER INSERT ON Panto_inquiry_file_log
+BEGIN
+    UPDATE Panto_inquiry_file_log SET rec_create_dt = getdate() WHERE rowid = new.rowid;
+END;
+"""
+
+# T-SQL the watcher uses that SQLite does not understand; getdate() is registered as a function instead
+TSQL_REWRITES = [(re.compile(r'with\s*\(\s*nolock\s*\)', re.IGNORECASE), ''),
+                 (re.compile(r'\bisnull\s*\(', re.IGNORECASE), 'ifnull(')]
+TIMESTAMP = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(\.\d+)?$')
+OSPREY_TIMEZONE = ZoneInfo('America/New_York')
+
+
+class OspreyTables:
+    """SQLite stand-in for the Osprey tables the watcher uses; dbo and dw_dbo are ATTACHed databases"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        con = self._open()
+        con.executescript(OSPREY_SCHEMA)
+        con.commit()
+        con.close()
+
+    def _open(self):
+        con = sqlite3.connect(os.path.join(self.directory, 'osprey.db'), check_same_thread=False)
+        for schema in ('dbo', 'dw_dbo'):
+            con.execute(f"ATTACH DATABASE ? AS {schema}", (os.path.join(self.directory, f"{schema}.db"),))
+        con.create_function('getdate', 0,
+                            lambda: datetime.datetime.now(OSPREY_TIMEZONE).strftime('%Y-%m-%d %H:%M:%S'))
+        return con
+
+    def add_schedules(self, rows):
+        con = self._open()
+        con.executemany("INSERT INTO dbo.panto_ip_file_transfer VALUES (?,?,?,?,?,?,?,?,?,?,?)", rows)
+        con.commit()
+        con.close()
+
+    def connect(self):
+        """A pyodbc style connection"""
+
+        return _OdbcConnection(self._open())
+
+    def log_rows(self):
+        con = self._open()
+        rows = con.execute("SELECT * FROM dw_dbo.Panto_inquiry_file_log").fetchall()
+        con.close()
+        return rows
+
+
+class _OdbcConnection:
+
+    def __init__(self, con):
+        self.con = con
+
+    def cursor(self):
+        return _OdbcCursor(self.con.cursor())
+
+    def commit(self):
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+
+class _OdbcCursor:
+    """pyodbc cursor behaviour on sqlite3: qmark parameters, a bare value as the only parameter, datetime columns"""
+
+    def __init__(self, cur):
+        self.cur = cur
+
+    def execute(self, sql, params=()):
+        for pattern, replacement in TSQL_REWRITES:
+            sql = pattern.sub(replacement, sql)
+        if not isinstance(params, (tuple, list)):
+            params = (params,)
+        self.cur.execute(sql, params)
+        return self
+
+    def fetchone(self):
+        row = self.cur.fetchone()
+        return None if row is None else self._row(row)
+
+    def fetchall(self):
+        return [self._row(row) for row in self.cur.fetchall()]
+
+    @staticmethod
+    def _row(row):
+        return tuple(datetime.datetime.fromisoformat(value) if isinstance(value, str) and TIMESTAMP.match(value)
+                     else value for value in row)
+
+
+# -- Zenaida SMB share ---------------------------------------------------------------------------------------------
+
+class _SharedFile:
+
+    def __init__(self, filename, file_size, last_write_time, is_directory=False):
+        self.filename = filename
+        self.file_size = file_size
+        self.last_write_time = last_write_time
+        self.isDirectory = is_directory
+
+
+class FakeSMBTree:
+    """In-memory SMB shares answering listPath/getAttributes like pysmb's SMBConnection, with latency_ms per call"""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency = latency_ms / 1000.0
+        self.files = {}
+        self.directories = set()
+
+    def add(self, service, path, file_size, last_write_time):
+        directory, name = posixpath.split(path)
+        self.directories.add((service, directory.rstrip('/')))
+        self.files[(service, path)] = _SharedFile(name, file_size, last_write_time)
+
+    def connect(self):
+        return _SMBConnection(self)
+
+
+class _SMBConnection:
+
+    def __init__(self, tree):
+        self.tree = tree
+
+    def listPath(self, service, path, pattern='*'):
+        time.sleep(self.tree.latency)
+        directory = path.rstrip('/')
+        if (service, directory) not in self.tree.directories:
+            raise smb_structs.OperationFailure(f"Failed to list {path} on {service}", [])
+        return [shared for (share, full_path), shared in sorted(self.tree.files.items())
+                if share == service and posixpath.dirname(full_path).rstrip('/') == directory
+                and fnmatch.fnmatch(shared.filename, pattern)]
+
+    def getAttributes(self, service, path):
+        time.sleep(self.tree.latency)
+        try:
+            return self.tree.files[(service, path)]
+        except KeyError:
+            raise smb_structs.OperationFailure(f"Unable to open {path} on {service}", [])
+
+    def close(self):
+        pass
+
+
+# -- Synthetic day -------------------------------------------------------------------------------------------------
+
+def scaled(scale):
+    return {name: max(1, int(round(count * scale))) if name != 'clearinghouse_bytes' else count
+            for name, count in BASE_DAY.items()}
+
+
+def school_schedules(volume, rng):
+    """dbo.panto_ip_file_transfer rows and, per schedule, the directory its files land in (None: invalid path)"""
+
+    rows, directories = [], {}
+    for number in range(1, volume['schools'] + 1):
+        directory = f"/schools/s{number:04d}"
+        valid = rng.random() >= INVALID_PATH_RATE
+        directories[number] = directory if valid else None
+        ftp_path = f"\\\\zenaida\\ftpsites{directory if valid else directory + '-moved'}/"
+        rows.append((number, f"S{number:04d}", f"School {number}", ftp_path, 'inquiries_*.csv', str(1000 + number),
+                     f"C{number:05d}", 'Inquiry Pool', 'Freshman', number, f"2021-01-{1 + number % 28:02d}"))
+    return rows, directories
+
+
+def land_school_files(tree, directories, volume, rng, share, last_write_time, sequence):
+    """Put share x files_per_school files in every valid school directory; returns how many landed"""
+
+    landed = 0
+    for number, directory in directories.items():
+        if directory is None:
+            continue
+        for _ in range(max(1, int(round(volume['files_per_school'] * share)))):
+            name = f"inquiries_{next(sequence):06d}.csv"
+            tree.add('ftpsites', f"{directory}/{name}", rng.randint(2_000, 200_000), last_write_time)
+            landed += 1
+    return landed
+
+
+def contact(partner, number, rng):
+    return {'fname': f"First{number}", 'lname': f"Last{number}", 'email': f"lead{number}@example.edu",
+            'partner': partner, 'score': rng.randint(0, 100)}
+
+
+# -- Measurement ---------------------------------------------------------------------------------------------------
+
+class StageReport:
+    """Wall time, items and the summed EMF metrics of every invocation of one stage"""
+
+    def __init__(self, name):
+        self.name = name
+        self.invocations = 0
+        self.items = 0
+        self.errors = 0
+        self.wall = 0.0
+        self.latency_ms = 0.0
+        self.kinds = {}
+
+    @contextlib.contextmanager
+    def measure(self):
+        out = io.StringIO()
+        started = time.perf_counter()
+        with contextlib.redirect_stdout(out):
+            yield
+        self.wall += time.perf_counter() - started
+        for line in out.getvalue().splitlines():
+            if line.startswith('{"_aws"'):
+                self.add_emf(json.loads(line))
+
+    def add_emf(self, record):
+        self.invocations += 1
+        self.errors += record.get('Error', 0)
+        self.latency_ms += record.get('Latency', 0.0)
+        for name, value in record.items():
+            match = re.match(r'^(.+)(Calls|Bytes|Time)$', name)
+            if match and not isinstance(value, dict):
+                kind = self.kinds.setdefault(match.group(1), {'Calls': 0, 'Bytes': 0, 'Time': 0.0})
+                kind[match.group(2)] += value
+
+    def lines(self):
+        rate = self.items / self.wall if self.wall else 0.0
+        yield (f"  {self.name:<10} {self.invocations:>5} invocations {self.items:>7} items {self.wall:>8.2f} s wall "
+               f"{rate:>9.1f} items/s {self.errors:>3} errors")
+        accounted = 0.0
+        for kind, totals in sorted(self.kinds.items(), key=lambda item: -item[1]['Time']):
+            accounted += totals['Time']
+            yield (f"      {kind:<15} {totals['Calls']:>7} calls {totals['Bytes'] / 1e6:>9.2f} MB "
+                   f"{totals['Time'] / 1000:>8.2f} s")
+        yield f"      {'in handler':<15} {'':>13} {'':>12} {max(self.latency_ms - accounted, 0) / 1000:>8.2f} s " \
+              f"(handler time not spent in external calls; calls on pool threads overlap)"
+
+
+# -- Stages --------------------------------------------------------------------------------------------------------
+
+@contextlib.contextmanager
+def load_s3_sftp(server_port):
+    """Load s3-sftp_1_9_2020.py with NSC layer modules pointing at the local SFTP server. The handlers import the
+    layer when they run, so it stays in place until the block exits"""
+
+    config = types.ModuleType('nsc_config')
+    config.secrets = {'host': '127.0.0.1', 'port': server_port, 'username': SFTP_USERNAME,
+                      'password': SFTP_PASSWORD, 'upload_dir': '/'}
+    config.nsc_log_channel = '#simulator'
+    helpers = types.ModuleType('nsc_helpers')
+    helpers.slack_messages = []
+    helpers.send_to_slack = lambda message, channel: helpers.slack_messages.append(message)
+    nsc_time = types.ModuleType('nsc_time')
+    nsc_time.pretty_time = lambda: datetime.datetime.now().strftime('%m/%d/%Y %H:%M')
+
+    with mock.patch.dict(sys.modules, {'nsc_config': config, 'nsc_helpers': helpers, 'nsc_time': nsc_time}):
+        spec = importlib.util.spec_from_file_location('s3_sftp', os.path.join(HERE, 's3-sftp_1_9_2020.py'))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+
+
+def run_watcher(reports, workdir, volume, rng, smb_latency_ms):
+    import boto3
+    import Inquiry_pool_File_watcher as watcher
+
+    report = reports['watcher']
+    tables = OspreyTables(workdir)
+    rows, directories = school_schedules(volume, rng)
+    tables.add_schedules(rows)
+    tree = FakeSMBTree(smb_latency_ms)
+    sequence = iter(range(1, 10 ** 9))
+
+    sqs = boto3.client('sqs', region_name='us-east-1')
+    queue_url = sqs.create_queue(QueueName='IPFilePathQueue')['QueueUrl']
+    watcher.get_sqs.cache_clear()
+
+    now = time.time()
+    runs = [(MORNING_SHARE, now - 3600), (1 - MORNING_SHARE, now + 60)]
+    with mock.patch.dict(os.environ, {'IPFilePathQueue_URL': queue_url}), \
+            mock.patch.object(watcher, 'connect_SQL_server', tables.connect), \
+            mock.patch.object(watcher, 'get_smb_connection', tree.connect):
+        for share, last_write_time in runs:
+            land_school_files(tree, directories, volume, rng, share, last_write_time, sequence)
+            with report.measure():
+                watcher.main()
+
+    attributes = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=['ApproximateNumberOfMessages'])
+    report.items = int(attributes['Attributes']['ApproximateNumberOfMessages'])
+    return {'log_rows': len(tables.log_rows()), 'messages': report.items}
+
+
+def run_you_visit(reports, workdir, volume, rng, api_rpm):
+    import boto3
+    import s3_io
+    import you_visit_api
+    from you_visit_simulator import TenantSpec, YouVisitSimulator, FakePantoDatabase
+
+    report = reports['you_visit']
+    s3_io.client().create_bucket(Bucket='panto-simulator')
+    sqs = boto3.client('sqs', region_name='us-east-1')
+    queue_url = sqs.create_queue(QueueName='YouVisitTenants')['QueueUrl']
+
+    specs = [TenantSpec(f"tenant-{number:04d}", volume['leads_per_tenant'], error_rate=0.0)
+             for number in range(1, volume['tenants'] + 1)]
+    database = FakePantoDatabase()
+    create_date_time = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    you_visit_api.api_rate_limiter = you_visit_api.RateLimiter(api_rpm)
+
+    with YouVisitSimulator(specs, requests_per_minute=api_rpm) as api, \
+            mock.patch.dict(os.environ, {'PANTO_BUCKET_NAME': 'panto-simulator'}), \
+            mock.patch.object(you_visit_api, 'in_aws', True), \
+            mock.patch.object(you_visit_api, 'connect_panto', lambda: (database.connect(), False)):
+        for number, spec in enumerate(specs, start=1):
+            member_sk = str(number)
+            database.launch(member_sk, create_date_time)
+            body = f"{number:05d}|token|{api.url_for(spec.tenant_guid)}|{create_date_time}|{spec.tenant_guid}|{member_sk}"
+            sqs.send_message(QueueUrl=queue_url, MessageBody=body)
+
+        while True:
+            messages = sqs.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10).get('Messages', [])
+            if not messages:
+                break
+            event = {'Records': [{'messageId': m['MessageId'], 'body': m['Body']} for m in messages]}
+            with report.measure():
+                failures = {f['itemIdentifier'] for f in you_visit_api.main(event, None)['batchItemFailures']}
+            for message in messages:
+                if message['MessageId'] not in failures:
+                    sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+                    report.items += 1
+            if failures:
+                # Left for the redrive policy in AWS; the replay does not retry them
+                report.errors += len(failures)
+                for message in messages:
+                    if message['MessageId'] in failures:
+                        sqs.delete_message(QueueUrl=queue_url, ReceiptHandle=message['ReceiptHandle'])
+        statuses = [database.status_of(str(number), create_date_time)['status_indicator']
+                    for number in range(1, len(specs) + 1)]
+    return {'statuses': {status: statuses.count(status) for status in set(statuses)},
+            'api_calls': sum(api.api_calls.values())}
+
+
+def run_delivery(reports, workdir, volume, rng):
+    import s3_io
+    import delivery_scheduler
+
+    report = reports['delivery']
+    client = s3_io.client()
+    for bucket in ('delivery-inbox', 'delivery-archive'):
+        client.create_bucket(Bucket=bucket)
+    for partner_number in range(1, volume['partners'] + 1):
+        partner = f"partner-{partner_number:04d}"
+        for number in range(volume['contacts_per_partner']):
+            client.put_object(Bucket='delivery-inbox', Key=f"inbox/{partner}/acs-{number:06d}.json",
+                              Body=json.dumps(contact(partner, number, rng)).encode('utf-8'))
+            report.items += 1
+
+    with mock.patch.dict(os.environ, {'SourceBucket': 'delivery-inbox', 'DestinationBucket': 'delivery-archive'}):
+        with report.measure():
+            delivery_scheduler.main({}, None)
+
+    archived = client.list_objects_v2(Bucket='delivery-archive').get('KeyCount', 0)
+    return {'partner_files': archived}
+
+
+def run_s3_sftp(reports, workdir, volume, rng, sftp_rtt_ms):
+    import s3_io
+    from local_sftp_server import LocalSFTPServer
+
+    report = reports['s3_sftp']
+    client = s3_io.client()
+    client.create_bucket(Bucket='nsc-clearinghouse')
+    keys = []
+    for number in range(volume['clearinghouse_files']):
+        key = f"clearinghouse/ch_{number:05d}.dat"
+        client.put_object(Bucket='nsc-clearinghouse', Key=key, Body=rng.randbytes(volume['clearinghouse_bytes']))
+        keys.append(key)
+
+    root = os.path.join(workdir, 'sftp')
+    with LocalSFTPServer(root, SFTP_USERNAME, SFTP_PASSWORD) as server:
+        proxy = None
+        port = server.port
+        if sftp_rtt_ms:
+            from bench_sftp_transfer import LatencyProxy
+            proxy = LatencyProxy(server.port, sftp_rtt_ms)
+            port = proxy.port
+        os.makedirs(os.path.join(root, 'clearinghouse'), exist_ok=True)
+        with load_s3_sftp(port) as module:
+            for key in keys:
+                # S3 notifications invoke the function with one record each
+                event = {'Records': [{'s3': {'bucket': {'name': 'nsc-clearinghouse'},
+                                             'object': {'key': key, 'size': volume['clearinghouse_bytes']}}}]}
+                with report.measure():
+                    try:
+                        module.on_trigger_event(event, None)
+                        report.items += 1
+                    except SystemExit:
+                        pass
+        if proxy is not None:
+            proxy.close()
+    delivered = len(os.listdir(os.path.join(root, 'clearinghouse')))
+    return {'delivered': delivered}
+
+
+def replay_day(scale, seed, api_rpm, smb_latency_ms, sftp_rtt_ms, stages):
+    """Replay one synthetic day at `scale`; returns ({stage: StageReport}, {stage: checks})"""
+
+    import s3_io
+
+    rng = random.Random(seed)
+    volume = scaled(scale)
+    reports = {stage: StageReport(stage) for stage in STAGES}
+    checks = {}
+    workdir = tempfile.mkdtemp(prefix='pipeline_simulator_')
+    try:
+        with mock_aws():
+            s3_io.client.cache_clear()
+            if 'watcher' in stages:
+                checks['watcher'] = run_watcher(reports, workdir, volume, rng, smb_latency_ms)
+            if 'you_visit' in stages:
+                checks['you_visit'] = run_you_visit(reports, workdir, volume, rng, api_rpm)
+            if 'delivery' in stages:
+                checks['delivery'] = run_delivery(reports, workdir, volume, rng)
+            if 's3_sftp' in stages:
+                checks['s3_sftp'] = run_s3_sftp(reports, workdir, volume, rng, sftp_rtt_ms)
+            s3_io.client.cache_clear()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return {stage: reports[stage] for stage in stages}, checks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scale', type=float, nargs='+', default=[1.0], help='multiples of the BASE_DAY volume')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES))
+    parser.add_argument('--api-rpm', type=int, default=100, help='YouVisit quota, requests per minute')
+    parser.add_argument('--smb-latency-ms', type=float, default=2.0, help='latency of every SMB call')
+    parser.add_argument('--sftp-rtt-ms', type=float, default=0.0, help='round trip latency to the SFTP server')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    # Lambda runs in UTC
+    os.environ['TZ'] = 'UTC'
+    time.tzset()
+    # The local SFTP server logs every connection the handler closes
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    sys.path.insert(0, HERE)
+
+    for scale in args.scale:
+        reports, checks = replay_day(scale, args.seed, args.api_rpm, args.smb_latency_ms, args.sftp_rtt_ms,
+                                     args.stages)
+        print(f"day at {scale:g}x: {scaled(scale)}")
+        for stage, report in reports.items():
+            for line in report.lines():
+                print(line)
+            print(f"      checks: {checks.get(stage)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,82 +4,191 @@ Created on Thu Jan  9 09:45:48 2020
 @author: Avadhoot(Avi) Patil
 Lambda function that triggers when a new file is in the S3 Bucket and sends it to the NSC SFTP
 
+Every record of the S3 notification is transferred over one authenticated SSH transport, each file on its own
+SFTP channel. How many channels are open at a time adapts to the observed transfer times and failures, up to
+SFTP_MAX_CHANNELS - see adaptive_concurrency
+
+Small objects under SFTP_BUNDLE_PREFIX are left to on_bundle_event, a scheduled entry-point that sends the ones not
+yet delivered as one archive - see sftp_bundle
+
+Slack notifications are queued and sent in the background as one summary per invocation - see slack_dispatcher
+
+The NSC layer (nsc_config fetches the secrets as it is imported) and paramiko are imported when a handler first needs
+them rather than at import
+
 """
 
+import datetime
+import functools
 import logging
 import os
-import boto3
-import paramiko
+from urllib.parse import unquote_plus
 import botocore.exceptions
-import nsc_config as config
-import nsc_helpers as helpers
-import nsc_time
+import adaptive_concurrency
+import lambda_metrics
+import s3_io
+import sftp_bundle
+import slack_dispatcher
+import sftp_transfer
 
 logger = logging.getLogger()
 logger.setLevel(os.getenv('LOGGING_LEVEL', 'DEBUG')) # logging level is DEBUG and higher 
 
 # Environmant variables
-SSH_HOST = config.secrets['host']          
-SSH_USERNAME = config.secrets['username']
-SSH_PASSWORD = config.secrets['password']
-SSH_PORT = config.secrets['port']
-SSH_DIR = config.secrets['upload_dir']
+SFTP_MAX_CHANNELS = int(os.getenv('SFTP_MAX_CHANNELS', 4))
+
+# SFTP login and upload directory from the NSC secrets, read once per container
+@functools.lru_cache(maxsize=1)
+def ssh_settings():
+    import nsc_config as config
 
-# Function to  making a connection to SFTP
+    return {
+        'hostname': config.secrets['host'],
+        'port': config.secrets['port'],
+        'username': config.secrets['username'],
+        'password': config.secrets['password'],
+    }
+
+@functools.lru_cache(maxsize=1)
+def ssh_dir():
+    import nsc_config as config
+
+    return config.secrets['upload_dir']
+
+# Function to  making a connection to SFTP - returns the authenticated transport the SFTP channels are opened on
 def connect_to_sftp(hostname, port, username, password):
+    import paramiko
     
-    transport = paramiko.Transport((hostname, port))
-
     # Program will exit if failure to Connect and Log an Exception 
     try :
-        transport.connect(username=username, password=password)
+        transport = sftp_transfer.open_transport(hostname, port, username, password)
 
     except paramiko.SSHException as ex :
         logger.exception("Connection to remote SFTP server failed ")  
         exit(1)
 
-    client = paramiko.SFTPClient.from_transport(transport)
     logger.info("S3-SFTP: Connected to remote SFTP server")
-    return client
+    return transport
+
+# Queues the Slack notifications of one invocation; flush() before returning
+def start_notifications():
+    import nsc_config as config
+    import nsc_helpers as helpers
+    import nsc_time
+
+    return slack_dispatcher.SlackDispatcher(helpers.send_to_slack, config.nsc_log_channel, nsc_time.pretty_time)
+
+# Transfer one S3 object on its own SFTP channel; returns 'SUCCESS', 'RESUMED', 'SKIPPED' or 'FAILED'.
+# Redelivered events are skipped and interrupted uploads resumed - see sftp_transfer.deliver
+def transfer_object(transport, s3_client, bucket, key, notifications):
+    import paramiko
+    sftp_client = paramiko.SFTPClient.from_transport(transport)
 
-# The entry-point for the trigger event 
-def on_trigger_event(event, context):
-    logger.info("S3-SFTP: received trigger event")
-    sftp_client = connect_to_sftp(
-        hostname=SSH_HOST,
-        port=SSH_PORT,
-        username=SSH_USERNAME,
-        password=SSH_PASSWORD
-    )
-    
-    sftp_client.chdir(SSH_DIR) 
-    logger.debug("S3-SFTP: Switched into remote SFTP upload directory")
-    
-    # Get the Bucket and Key attributes 
-    bucket = event['Records'][0]['s3']['bucket']['name']
-    key = event['Records'][0]['s3']['object']['key']
-    logger.info(f"S3-SFTP: Received trigger on '{ key }'")
-       
-    s3_file= boto3.resource('s3',region_name = 'us-east-1').Object(bucket, key)   #s3_file_object
-    
  # SFTP File Trasnfer
     try :
-        logger.info(f"S3-SFTP: Transferring S3 file '{s3_file.key}' started")
-        with sftp_client.file(s3_file.key, 'w') as sftp_file:
-            s3_file.download_fileobj(Fileobj=sftp_file)
-        logger.info(f"S3-SFTP: Transferred successfully '{ s3_file.key }' from S3 to SFTP")
-        status_message = f"{nsc_time.pretty_time()} File uploaded successfully: {key}"
-        helpers.send_to_slack(status_message, config.nsc_log_channel)
+        sftp_client.chdir(ssh_dir()) 
+        logger.debug("S3-SFTP: Switched into remote SFTP upload directory")
+        logger.info(f"S3-SFTP: Transferring S3 file '{key}' started")
+        outcome = sftp_transfer.deliver(sftp_client, s3_client, bucket, key, key, channels=SFTP_MAX_CHANNELS)
+        if outcome == 'SKIPPED':
+            return 'SKIPPED'
+        logger.info(f"S3-SFTP: Transferred successfully '{ key }' from S3 to SFTP")
+        notifications.notify("File uploaded successfully", key)
+        return 'SUCCESS' if outcome == 'TRANSFERRED' else outcome
     
-    except paramiko.IOError as e : 
-        logger.exception("S3-SFTP: Transferred Failed , File on SFTP cannot be opened in Write Mode")
-        status_message = f"{nsc_time.pretty_time()} Error while attempting to upload: {key}"
-        helpers.send_to_slack(status_message, config.nsc_log_channel)
-        exit(1)
+    except IOError as e : 
+        logger.exception(f"S3-SFTP: Transferred Failed , File '{key}' on SFTP cannot be opened in Write Mode")
     
-    except  botocore.exceptions.BotoCoreError as b :
-      logger.exception("S3-SFTP: Transferred Failed , Issue with the S3 Bucket/File")
-      status_message = f"{nsc_time.pretty_time()} Error while attempting to upload: {key}"
-      helpers.send_to_slack(status_message, config.nsc_log_channel)
-      exit(1) 
-        
\ No newline at end of file
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as b :
+        logger.exception(f"S3-SFTP: Transferred Failed , Issue with the S3 Bucket/File '{key}'")
+
+    finally:
+        sftp_client.close()
+
+    notifications.notify("Error while attempting to upload", key)
+    return 'FAILED'
+
+# The entry-point for the trigger event 
+@lambda_metrics.instrument('s3-sftp')
+def on_trigger_event(event, context):
+    logger.info(f"S3-SFTP: received trigger event with {len(event['Records'])} record(s)")
+
+    # Get the Bucket and Key attributes of every record; keys arrive URL encoded
+    objects = []
+    for record in event['Records']:
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+        logger.info(f"S3-SFTP: Received trigger on '{ key }'")
+        if sftp_bundle.is_bundled(key, record['s3']['object'].get('size')):
+            logger.info(f"S3-SFTP: '{ key }' is left for the next bundle")
+            continue
+        objects.append((bucket, key))
+    if not objects:
+        return {}
+
+    transport = connect_to_sftp(**ssh_settings())
+    s3_client = s3_io.client()
+    notifications = start_notifications()
+
+    try:
+        # A transfer takes as long as its file is big, so its time says nothing about congestion
+        channels = adaptive_concurrency.AdaptiveConcurrency('S3-SFTP channels', maximum=SFTP_MAX_CHANNELS,
+                                                            initial=2, latency_tolerance=None, context=context)
+        transferred = channels.map(lambda o: transfer_object(transport, s3_client, *o, notifications), objects,
+                                   classify=lambda outcome: adaptive_concurrency.ERROR if outcome == 'FAILED'
+                                   else adaptive_concurrency.OK)
+        # An object not started for lack of time is failed too, so the retry of the event picks it up
+        outcomes = ['FAILED' if error else outcome for outcome, error in transferred]
+    finally:
+        transport.close()
+        notifications.flush(context=context)
+
+    results = {key: outcome for (bucket, key), outcome in zip(objects, outcomes)}
+    for key, outcome in results.items():
+        logger.info(f"S3-SFTP: {outcome} '{ key }'")
+
+    if 'FAILED' in outcomes:
+        exit(1)
+    return results
+
+# The entry-point for the scheduled bundling event. Sends every object under SFTP_BUNDLE_PREFIX not yet delivered,
+# modified before the end of the last complete window, as one archive. A backfill event with window_start (UTC unless
+# it carries an offset) sends the undelivered objects of that window only, however old
+@lambda_metrics.instrument('s3-sftp-bundle')
+def on_bundle_event(event, context):
+    event = event or {}
+    bucket = event.get('bucket') or os.environ['SFTP_BUNDLE_BUCKET']
+    since = None
+    if event.get('window_start'):
+        start = sftp_bundle.parse_window_start(event['window_start'])
+        end = start + datetime.timedelta(seconds=sftp_bundle.SFTP_BUNDLE_WINDOW_SECONDS)
+        since = start
+    else:
+        start, end = sftp_bundle.window_bounds(datetime.datetime.now(datetime.timezone.utc))
+    logger.info(f"S3-SFTP: bundling undelivered '{sftp_bundle.SFTP_BUNDLE_PREFIX}' objects modified before {end}")
+
+    transport = connect_to_sftp(**ssh_settings())
+    s3_client = s3_io.client()
+    import paramiko
+    sftp_client = paramiko.SFTPClient.from_transport(transport)
+    notifications = start_notifications()
+
+    try :
+        sftp_client.chdir(ssh_dir())
+        manifest = sftp_bundle.send_bundle(sftp_client, s3_client, bucket, sftp_bundle.SFTP_BUNDLE_PREFIX, start, end,
+                                           since=since)
+
+    except (IOError, botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError) as e :
+        logger.exception("S3-SFTP: Bundle transfer failed")
+        notifications.notify("Error while attempting to upload the bundle", f"{start} to {end}")
+        notifications.flush(context=context)
+        exit(1)
+
+    finally:
+        sftp_client.close()
+        transport.close()
+
+    if manifest is not None:
+        notifications.notify("Bundle uploaded successfully", f"{manifest['bundle']} ({manifest['count']} files)")
+    notifications.flush(context=context)
+    return manifest
@@ -0,0 +1,111 @@
+""" Shared S3 I/O for the lambdas.
+
+Every handler gets its S3 client from client(): one client per process (boto3 clients are thread safe), reused across
+warm invocations, with a connection pool sized for the threads that share it (S3_MAX_POOL_CONNECTIONS; the botocore
+default of 10 is smaller than e.g. SFTP_MAX_CHANNELS x S3_RANGE_CONCURRENCY in s3-sftp) and adaptive retries, which
+back off client side when S3 answers with throttling errors. Managed uploads, downloads and copies use
+transfer_config(), whose multipart threshold, part size and concurrency come from the environment.
+
+    S3_MAX_POOL_CONNECTIONS      connection pool size of the shared client (32)
+    S3_RETRY_MODE                botocore retry mode (adaptive)
+    S3_MAX_ATTEMPTS              attempts per request, including the first (8)
+    S3_MULTIPART_THRESHOLD       size from which transfers go multipart (8 MiB)
+    S3_MULTIPART_CHUNKSIZE       part size of multipart transfers and streaming writes (8 MiB)
+    S3_TRANSFER_CONCURRENCY      threads per managed transfer (10)
+
+"""
+import functools
+import json
+import os
+
+import boto3
+from botocore.config import Config
+
+S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+S3_MAX_POOL_CONNECTIONS = int(os.getenv('S3_MAX_POOL_CONNECTIONS', 32))
+S3_RETRY_MODE = os.getenv('S3_RETRY_MODE', 'adaptive')
+S3_MAX_ATTEMPTS = int(os.getenv('S3_MAX_ATTEMPTS', 8))
+S3_MULTIPART_THRESHOLD = int(os.getenv('S3_MULTIPART_THRESHOLD', 8 * 1024 * 1024))
+S3_MULTIPART_CHUNKSIZE = int(os.getenv('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024))
+S3_TRANSFER_CONCURRENCY = int(os.getenv('S3_TRANSFER_CONCURRENCY', 10))
+
+def client_config():
+    """botocore Config of the shared client"""
+
+    return Config(region_name=S3_REGION, max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                  retries={'mode': S3_RETRY_MODE, 'total_max_attempts': S3_MAX_ATTEMPTS})
+
+
+@functools.lru_cache(maxsize=None)
+def client():
+    """The process wide S3 client"""
+
+    return boto3.client('s3', config=client_config())
+
+
+@functools.lru_cache(maxsize=None)
+def transfer_config():
+    """TransferConfig for managed uploads, downloads and copies"""
+
+    from boto3.s3.transfer import TransferConfig
+
+    return TransferConfig(multipart_threshold=S3_MULTIPART_THRESHOLD, multipart_chunksize=S3_MULTIPART_CHUNKSIZE,
+                          max_concurrency=S3_TRANSFER_CONCURRENCY, use_threads=S3_TRANSFER_CONCURRENCY > 1)
+
+
+# Reading
+
+def get_body(bucket, key, first=None, last=None, s3_client=None, if_match=None):
+    """Streaming body of s3://bucket/key, or of its inclusive byte range [first, last]. s3_client defaults to the
+    shared client. With if_match, S3 refuses (412 PreconditionFailed) to serve any other version than that ETag"""
+
+    kwargs = {'Bucket': bucket, 'Key': key}
+    if first is not None:
+        kwargs['Range'] = f"bytes={first}-{'' if last is None else last}"
+    if if_match is not None:
+        kwargs['IfMatch'] = '"' + if_match.strip('"') + '"'
+    return (s3_client or client()).get_object(**kwargs)['Body']
+
+
+def read_range(bucket, key, first, last, s3_client=None, if_match=None):
+    """Bytes first..last (inclusive) of s3://bucket/key"""
+
+    return get_body(bucket, key, first, last, s3_client=s3_client, if_match=if_match).read()
+
+
+def read_json(bucket, key):
+    """Parse a JSON object"""
+
+    return json.loads(get_body(bucket, key).read().decode('utf-8'))
+
+
+# Writing
+
+def upload_file(full_file_path, bucket, key):
+    """Managed (multipart above S3_MULTIPART_THRESHOLD) upload of a local file"""
+
+    client().upload_file(full_file_path, bucket, key, Config=transfer_config())
+
+
+def copy(source_bucket, source_key, bucket, key):
+    """Managed server side copy"""
+
+    client().copy({'Bucket': source_bucket, 'Key': source_key}, bucket, key, Config=transfer_config())
+
+
+def delete(bucket, key):
+    """Delete s3://bucket/key"""
+
+    client().delete_object(Bucket=bucket, Key=key)
+
+
+def open_s3(bucket, key, mode='rb', **kwargs):
+    """Stream s3://bucket/key through smart_open on the shared client. Writes are sent as S3_MULTIPART_CHUNKSIZE
+    parts while the file is being written, so nothing is staged on disk or held whole in memory.
+
+    smart_open is only packaged with the functions that stream to S3, so it is imported here."""
+
+    from smart_open import open as smart_open
+
+    transport_params = {'client': client(), 'min_part_size': max(S3_MULTIPART_CHUNKSIZE, 5 * 1024 * 1024)}
+    return smart_open(f"s3://{bucket}/{key}", mode, transport_params=transport_params, **kwargs)
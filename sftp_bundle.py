@@ -0,0 +1,192 @@
+""" Small-file bundling for the NSC S3-SFTP lambda.
+
+When SFTP_BUNDLE_PREFIX is set, objects under that prefix of at most SFTP_BUNDLE_MAX_OBJECT_BYTES are not sent one
+by one from the S3 trigger. A scheduled invocation instead collects every one of them that has not been delivered yet
+and streams them into a single tar.gz or zip (SFTP_BUNDLE_FORMAT) on the SFTP server, with a MANIFEST.json as the first
+member. Objects are copied in chunks straight from the S3 response into the archive, so memory does not grow with the
+bundle size.
+
+Delivery is recorded the same way as for single files: once the bundle is in place every object in it gets the
+sftp_transfer.DELIVERED_ETAG_TAG tag with its ETag. A run picks up whatever lacks that tag, so a missed or failed
+schedule, or an object listed only after the run for its window, goes out with the next bundle. Only objects modified
+in the last SFTP_BUNDLE_LOOKBACK_SECONDS before the end of the run's window are considered, which bounds the tag
+reads; an outage longer than that needs a backfill event. The bundle name carries the window and a digest of its
+objects, so a retry of a bundle that is already in place only tags its objects.
+
+"""
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import posixpath
+import shutil
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_metrics
+import s3_io
+import sftp_transfer
+
+logger = logging.getLogger()
+
+SFTP_BUNDLE_PREFIX = os.getenv('SFTP_BUNDLE_PREFIX', '')
+SFTP_BUNDLE_MAX_OBJECT_BYTES = int(os.getenv('SFTP_BUNDLE_MAX_OBJECT_BYTES', 1024 * 1024))
+SFTP_BUNDLE_WINDOW_SECONDS = int(os.getenv('SFTP_BUNDLE_WINDOW_SECONDS', 900))
+SFTP_BUNDLE_FORMAT = os.getenv('SFTP_BUNDLE_FORMAT', 'tar.gz')
+SFTP_BUNDLE_LOOKBACK_SECONDS = int(os.getenv('SFTP_BUNDLE_LOOKBACK_SECONDS', 24 * 3600))
+COPY_CHUNK_SIZE = 1024 * 1024
+TAG_CONCURRENCY = 16
+
+
+def is_bundled(key, size):
+    """True when bundling is enabled and the object is left for the scheduled bundle"""
+
+    return bool(SFTP_BUNDLE_PREFIX) and key.startswith(SFTP_BUNDLE_PREFIX) and size is not None \
+        and size <= SFTP_BUNDLE_MAX_OBJECT_BYTES
+
+
+def window_bounds(now, window_seconds=None):
+    """The last complete window before `now`, as (start, end) UTC datetimes"""
+
+    window_seconds = window_seconds or SFTP_BUNDLE_WINDOW_SECONDS
+    epoch = int(now.timestamp())
+    end = epoch - epoch % window_seconds
+    return (datetime.datetime.fromtimestamp(end - window_seconds, datetime.timezone.utc),
+            datetime.datetime.fromtimestamp(end, datetime.timezone.utc))
+
+
+def parse_window_start(value):
+    """event['window_start'] as an aware datetime; a time without an offset is taken as UTC"""
+
+    start = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if start.tzinfo is None:
+        start = start.replace(tzinfo=datetime.timezone.utc)
+    return start
+
+
+def list_undelivered_objects(s3_client, bucket, prefix, since, end):
+    """Objects under prefix, small enough to bundle, last modified in [since, end) and not yet delivered with their
+    current ETag"""
+
+    candidates = []
+    for page in s3_client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if since <= obj['LastModified'] < end and obj['Size'] <= SFTP_BUNDLE_MAX_OBJECT_BYTES:
+                candidates.append(obj)
+
+    with ThreadPoolExecutor(max_workers=TAG_CONCURRENCY) as executor:
+        delivered = list(executor.map(lambda obj: sftp_transfer.delivered_etag(s3_client, bucket, obj['Key']),
+                                      candidates))
+    objects = [obj for obj, etag in zip(candidates, delivered) if etag != obj['ETag'].strip('"')]
+    return sorted(objects, key=lambda obj: obj['Key'])
+
+
+def bundle_name(prefix, start, objects, bundle_format=None):
+    """Deterministic remote name of a bundle: the window and a digest of the objects (keys and ETags) in it, e.g.
+    nsc-bundle-20210105T101500Z-3f2a9c1e.tar.gz"""
+
+    label = posixpath.basename(prefix.rstrip('/')) or 'nsc'
+    digest = hashlib.sha1(''.join(f"{obj['Key']}\0{obj['ETag']}\n" for obj in objects).encode('utf-8'))
+    return f"{label}-bundle-{start.strftime('%Y%m%dT%H%M%SZ')}-{digest.hexdigest()[:8]}." \
+           f"{bundle_format or SFTP_BUNDLE_FORMAT}"
+
+
+def mark_bundled(s3_client, bucket, objects):
+    """Tag every object of a delivered bundle with its ETag"""
+
+    with ThreadPoolExecutor(max_workers=TAG_CONCURRENCY) as executor:
+        list(executor.map(lambda obj: sftp_transfer.mark_delivered(s3_client, bucket, obj['Key'],
+                                                                   obj['ETag'].strip('"')), objects))
+
+
+def build_manifest(name, bucket, objects, start, end):
+    return {
+        'bundle': name,
+        'bucket': bucket,
+        'window_start': start.isoformat(),
+        'window_end': end.isoformat(),
+        'count': len(objects),
+        'bytes': sum(obj['Size'] for obj in objects),
+        'objects': [{'key': obj['Key'], 'size': obj['Size'], 'etag': obj['ETag'].strip('"'),
+                     'last_modified': obj['LastModified'].isoformat()} for obj in objects],
+    }
+
+
+class _WriteOnly:
+    """Hides seek/tell so zipfile writes sequentially with data descriptors instead of seeking back over SFTP to
+    patch local headers (a buffered paramiko file also reports a stale tell() until it is flushed)"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def write(self, data):
+        self.fileobj.write(data)
+        return len(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def write_bundle(s3_client, bucket, objects, manifest, sftp_file, bundle_format=None):
+    """Stream the manifest and every object into sftp_file as a tar.gz or zip archive"""
+
+    bundle_format = bundle_format or SFTP_BUNDLE_FORMAT
+    manifest_bytes = json.dumps(manifest, indent=2).encode('utf-8')
+
+    if bundle_format == 'tar.gz':
+        with tarfile.open(fileobj=sftp_file, mode='w|gz') as archive:
+            info = tarfile.TarInfo('MANIFEST.json')
+            info.size = len(manifest_bytes)
+            archive.addfile(info, io.BytesIO(manifest_bytes))
+            for obj in objects:
+                body = s3_io.get_body(bucket, obj['Key'], s3_client=s3_client, if_match=obj['ETag'])
+                info = tarfile.TarInfo(obj['Key'])
+                info.size = obj['Size']
+                info.mtime = obj['LastModified'].timestamp()
+                archive.addfile(info, body)
+    elif bundle_format == 'zip':
+        with zipfile.ZipFile(_WriteOnly(sftp_file), mode='w', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('MANIFEST.json', manifest_bytes)
+            for obj in objects:
+                body = s3_io.get_body(bucket, obj['Key'], s3_client=s3_client, if_match=obj['ETag'])
+                info = zipfile.ZipInfo(obj['Key'], date_time=obj['LastModified'].timetuple()[:6])
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info, mode='w', force_zip64=True) as member:
+                    shutil.copyfileobj(body, member, COPY_CHUNK_SIZE)
+    else:
+        raise Exception(f'Unsupported SFTP_BUNDLE_FORMAT {bundle_format}')
+
+
+def send_bundle(sftp_client, s3_client, bucket, prefix, start, end, bundle_format=None, since=None):
+    """Bundle every undelivered object modified in [since, end) onto the SFTP server (since defaults to
+    SFTP_BUNDLE_LOOKBACK_SECONDS before end); returns the manifest, or None when there was nothing to send or the same
+    bundle is already there"""
+
+    bundle_format = bundle_format or SFTP_BUNDLE_FORMAT
+    since = since or end - datetime.timedelta(seconds=SFTP_BUNDLE_LOOKBACK_SECONDS)
+    objects = list_undelivered_objects(s3_client, bucket, prefix, since, end)
+    if not objects:
+        logger.info(f"S3-SFTP: No undelivered objects under '{prefix}' between {since} and {end}")
+        return None
+
+    name = bundle_name(prefix, start, objects, bundle_format)
+    if sftp_transfer.remote_size(sftp_client, name) is not None:
+        # An earlier attempt put the bundle in place but did not get to tag all of its objects
+        logger.info(f"S3-SFTP: Bundle '{name}' already delivered, tagging its objects")
+        mark_bundled(s3_client, bucket, objects)
+        return None
+
+    manifest = build_manifest(name, bucket, objects, start, end)
+    temporary = sftp_transfer.temporary_name(name, 'bundle')
+    started = time.perf_counter()
+    with sftp_transfer.open_remote(sftp_client, temporary, 'w') as sftp_file:
+        write_bundle(s3_client, bucket, objects, manifest, sftp_file, bundle_format)
+    sftp_transfer.rename_into_place(sftp_client, temporary, name)
+    lambda_metrics.record('SFTP', manifest['bytes'], seconds=time.perf_counter() - started)
+    mark_bundled(s3_client, bucket, objects)
+    logger.info(f"S3-SFTP: Bundle '{name}' delivered with {manifest['count']} objects, {manifest['bytes']} bytes")
+    return manifest
@@ -0,0 +1,218 @@
+""" Streaming S3 -> SFTP transfer engine used by the NSC S3-SFTP lambda.
+
+The SSH transport is opened with a large channel window and packet size, the remote file is written pipelined (write
+requests are not acknowledged one at a time) through a large buffer, and the S3 object is fetched as parallel ranged
+GETs that are written to the remote file in order. One transfer holds up to `concurrency` fetched ranges plus the one
+being written, and SFTP_BUFFER_SIZE of remote write buffer: (concurrency + 1) x range_size + SFTP_BUFFER_SIZE bytes.
+range_settings() sizes the ranges so the transfers running side by side stay within SFTP_TRANSFER_MEMORY together.
+
+deliver() makes the transfer idempotent: the file is written under a hidden temporary name that carries the S3 ETag
+and renamed into place once complete, an interrupted upload is resumed from the size of that temporary file with a
+ranged GET, and an object whose delivered ETag (kept as the DELIVERED_ETAG_TAG tag on the S3 object) and size match
+the remote file is skipped.
+
+paramiko is imported by open_transport, so importing this module does not load it.
+
+"""
+import logging
+import os
+import posixpath
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import lambda_metrics
+import s3_io
+
+logger = logging.getLogger()
+
+SFTP_WINDOW_SIZE = int(os.getenv('SFTP_WINDOW_SIZE', 32 * 1024 * 1024))
+SFTP_MAX_PACKET_SIZE = int(os.getenv('SFTP_MAX_PACKET_SIZE', 256 * 1024))
+SFTP_BUFFER_SIZE = int(os.getenv('SFTP_BUFFER_SIZE', 1024 * 1024))
+# Memory every transfer of the container together may hold in ranges and write buffers: a quarter of the function's
+# memory (128 MB functions -> 32 MiB). S3_RANGE_SIZE / S3_RANGE_CONCURRENCY, when set, override the sizing
+SFTP_TRANSFER_MEMORY = int(os.getenv('SFTP_TRANSFER_MEMORY',
+                                     int(os.getenv('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 128)) * 1024 * 1024 // 4))
+S3_RANGE_SIZE = int(os.getenv('S3_RANGE_SIZE', 0))
+S3_RANGE_CONCURRENCY = int(os.getenv('S3_RANGE_CONCURRENCY', 0))
+DEFAULT_RANGE_CONCURRENCY = 4
+MIN_RANGE_SIZE = 256 * 1024
+DELIVERED_ETAG_TAG = os.getenv('SFTP_DELIVERED_ETAG_TAG', 'sftp-delivered-etag')
+
+
+def open_transport(hostname, port, username, password):
+    """Connect and authenticate an SSH transport with tuned window and packet sizes"""
+
+    import paramiko
+
+    started = time.perf_counter()
+    transport = paramiko.Transport((hostname, port), default_window_size=SFTP_WINDOW_SIZE,
+                                   default_max_packet_size=SFTP_MAX_PACKET_SIZE)
+    transport.connect(username=username, password=password)
+    lambda_metrics.record('SSHConnect', seconds=time.perf_counter() - started)
+    return transport
+
+
+def open_remote(sftp_client, path, mode='w'):
+    """Open a remote file for pipelined, buffered writes"""
+
+    sftp_file = sftp_client.open(path, mode, bufsize=SFTP_BUFFER_SIZE)
+    sftp_file.set_pipelined(True)
+    return sftp_file
+
+
+def range_settings(channels=1):
+    """(range_size, concurrency) for one of `channels` transfers running at once, so that together they hold at most
+    SFTP_TRANSFER_MEMORY. Ranges are a multiple of MIN_RANGE_SIZE and never smaller than it"""
+
+    budget = max(0, SFTP_TRANSFER_MEMORY // max(1, channels) - SFTP_BUFFER_SIZE)
+    concurrency = S3_RANGE_CONCURRENCY or \
+        max(1, min(DEFAULT_RANGE_CONCURRENCY, budget // MIN_RANGE_SIZE - 1))
+    range_size = S3_RANGE_SIZE or \
+        max(MIN_RANGE_SIZE, budget // (concurrency + 1) // MIN_RANGE_SIZE * MIN_RANGE_SIZE)
+    return range_size, concurrency
+
+
+def byte_ranges(start, size, range_size):
+    """Split [start, size) into inclusive (first, last) byte ranges of range_size"""
+
+    return [(first, min(first + range_size, size) - 1) for first in range(start, size, range_size)]
+
+
+def stream_s3_to_sftp(s3_client, bucket, key, sftp_file, size=None, start=0, range_size=None, concurrency=None,
+                      channels=1, etag=None):
+    """Copy s3://bucket/key from byte `start` onwards into sftp_file; returns the number of bytes written.
+
+    Ranges are fetched by `concurrency` threads and written strictly in order, so sftp_file can be a plain
+    sequential (or appending) remote file. Unset, range_size and concurrency come from range_settings(channels).
+    Every range is fetched with If-Match on etag (read with the size when either is unset), so an object overwritten
+    mid-transfer fails it with PreconditionFailed instead of mixing two versions in one file."""
+
+    default_range_size, default_concurrency = range_settings(channels)
+    range_size = range_size or default_range_size
+    concurrency = max(1, concurrency or default_concurrency)
+    if size is None or etag is None:
+        head = s3_client.head_object(Bucket=bucket, Key=key)
+        size = head['ContentLength'] if size is None else size
+        etag = head['ETag'] if etag is None else etag
+    ranges = byte_ranges(start, size, range_size)
+    if not ranges:
+        return 0
+
+    def fetch(byte_range):
+        return s3_io.read_range(bucket, key, byte_range[0], byte_range[1], s3_client=s3_client, if_match=etag)
+
+    written = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = deque()
+        upcoming = iter(ranges)
+        for byte_range in upcoming:
+            pending.append(executor.submit(fetch, byte_range))
+            if len(pending) >= concurrency:
+                break
+        while pending:
+            chunk = pending.popleft().result()
+            next_range = next(upcoming, None)
+            if next_range is not None:
+                pending.append(executor.submit(fetch, next_range))
+            sftp_file.write(chunk)
+            written += len(chunk)
+    sftp_file.flush()
+    lambda_metrics.record('SFTP', written, seconds=time.perf_counter() - started)
+    logger.debug(f"S3-SFTP: streamed {written} bytes of '{key}' in {len(ranges)} range(s)")
+    return written
+
+
+def remote_size(sftp_client, path):
+    """Size of a remote file, or None when it does not exist"""
+
+    try:
+        return sftp_client.stat(path).st_size
+    except IOError:
+        return None
+
+
+def temporary_name(path, etag):
+    """Hidden name the object is written under until complete, e.g. dir/.file.dat.<etag>.part"""
+
+    directory, name = posixpath.split(path)
+    return posixpath.join(directory, f".{name}.{etag}.part")
+
+
+def rename_into_place(sftp_client, temporary, path):
+    """Atomically replace `path` with the completed `temporary` file, so only complete files appear under real names"""
+
+    try:
+        sftp_client.posix_rename(temporary, path)
+    except IOError:
+        # Server without the posix-rename extension
+        if remote_size(sftp_client, path) is not None:
+            sftp_client.remove(path)
+        sftp_client.rename(temporary, path)
+
+
+def delivered_etag(s3_client, bucket, key):
+    """ETag recorded on the S3 object by the last successful delivery, if any"""
+
+    try:
+        tags = s3_client.get_object_tagging(Bucket=bucket, Key=key)['TagSet']
+    except Exception:
+        logger.exception(f"S3-SFTP: Unable to read the tags of '{key}', treating it as not delivered")
+        return None
+    for tag in tags:
+        if tag['Key'] == DELIVERED_ETAG_TAG:
+            return tag['Value']
+    return None
+
+
+def mark_delivered(s3_client, bucket, key, etag):
+    """Record the delivered ETag on the S3 object, keeping its other tags"""
+
+    try:
+        tags = [t for t in s3_client.get_object_tagging(Bucket=bucket, Key=key)['TagSet']
+                if t['Key'] != DELIVERED_ETAG_TAG]
+        tags.append({'Key': DELIVERED_ETAG_TAG, 'Value': etag})
+        s3_client.put_object_tagging(Bucket=bucket, Key=key, Tagging={'TagSet': tags})
+    except Exception:
+        # The file is delivered; a redelivery will simply be sent again
+        logger.exception(f"S3-SFTP: Unable to tag '{key}' as delivered")
+
+
+def deliver(sftp_client, s3_client, bucket, key, path, channels=1):
+    """Copy s3://bucket/key to the remote `path`, skipping or resuming where possible. `channels` is the number of
+    deliveries that may run at once, which share the memory budget.
+
+    Returns 'SKIPPED' (already delivered), 'RESUMED' (continued an interrupted upload) or 'TRANSFERRED'."""
+
+    head = s3_client.head_object(Bucket=bucket, Key=key)
+    size = head['ContentLength']
+    etag = head['ETag'].strip('"')
+
+    if remote_size(sftp_client, path) == size and delivered_etag(s3_client, bucket, key) == etag:
+        logger.info(f"S3-SFTP: '{key}' already delivered with ETag {etag}, skipping")
+        return 'SKIPPED'
+
+    temporary = temporary_name(path, etag)
+    offset = remote_size(sftp_client, temporary) or 0
+    if offset > size:
+        sftp_client.remove(temporary)
+        offset = 0
+
+    if offset:
+        logger.info(f"S3-SFTP: Resuming '{key}' at byte {offset} of {size}")
+        with open_remote(sftp_client, temporary, 'r+') as sftp_file:
+            sftp_file.seek(offset)
+            stream_s3_to_sftp(s3_client, bucket, key, sftp_file, size=size, start=offset, channels=channels,
+                              etag=etag)
+    else:
+        with open_remote(sftp_client, temporary, 'w') as sftp_file:
+            stream_s3_to_sftp(s3_client, bucket, key, sftp_file, size=size, channels=channels, etag=etag)
+
+    written = remote_size(sftp_client, temporary)
+    if written != size:
+        raise IOError(f"Remote file {temporary} has {written} bytes, expected {size}")
+
+    rename_into_place(sftp_client, temporary, path)
+    mark_delivered(s3_client, bucket, key, etag)
+    return 'RESUMED' if offset else 'TRANSFERRED'
@@ -0,0 +1,116 @@
+""" Non-blocking, aggregated Slack notifications for the NSC S3-SFTP lambda.
+
+notify() only puts the event on a queue; a background worker sends it with helpers.send_to_slack. Events that arrive
+within SLACK_SUMMARY_SECONDS of each other are combined into a single summary message, one line per kind of event,
+e.g.
+
+    01/09/2020 09:45 File uploaded successfully (3): a.dat, b.dat, c.dat
+    01/09/2020 09:45 Error while attempting to upload (1): d.dat
+
+The handler must call flush() before it returns: a Lambda's background threads are frozen once the handler returns,
+so anything still queued would otherwise be sent late or never. flush() waits at most SLACK_FLUSH_TIMEOUT seconds
+(less when the invocation has less time left), so a slow webhook cannot run the handler into its timeout.
+
+"""
+import logging
+import os
+import queue
+import threading
+import time
+
+logger = logging.getLogger()
+
+SLACK_SUMMARY_SECONDS = float(os.getenv('SLACK_SUMMARY_SECONDS', 5))
+SLACK_FLUSH_TIMEOUT = float(os.getenv('SLACK_FLUSH_TIMEOUT', 10))
+SLACK_SUMMARY_MAX_ITEMS = int(os.getenv('SLACK_SUMMARY_MAX_ITEMS', 25))
+
+# Time kept back from the Lambda's remaining time when flushing
+FLUSH_MARGIN_SECONDS = 1.0
+
+_FLUSH = object()
+
+
+def summarize(events, pretty_time, max_items=None):
+    """One summary message for a list of (kind, item) events, kinds in the order they were first seen"""
+
+    max_items = max_items or SLACK_SUMMARY_MAX_ITEMS
+    grouped = {}
+    for kind, item in events:
+        grouped.setdefault(kind, []).append(item)
+
+    lines = []
+    for kind, items in grouped.items():
+        listed = ', '.join(str(item) for item in items[:max_items])
+        if len(items) > max_items:
+            listed += f" and {len(items) - max_items} more"
+        lines.append(f"{pretty_time} {kind} ({len(items)}): {listed}")
+    return '\n'.join(lines)
+
+
+class SlackDispatcher:
+    """Queues (kind, item) events and sends them as summaries to `channel` on a background thread.
+
+    send(message, channel) does the actual posting (helpers.send_to_slack) and pretty_time() stamps each summary."""
+
+    def __init__(self, send, channel, pretty_time, summary_seconds=None):
+        self.send = send
+        self.channel = channel
+        self.pretty_time = pretty_time
+        self.summary_seconds = SLACK_SUMMARY_SECONDS if summary_seconds is None else summary_seconds
+        self.events = queue.Queue()
+        self.sent = 0
+        self.worker = threading.Thread(target=self._run, name='slack-dispatcher', daemon=True)
+        self.worker.start()
+
+    def notify(self, kind, item):
+        """Queue an event without blocking"""
+
+        self.events.put((kind, item))
+
+    def flush(self, timeout=None, context=None):
+        """Send everything queued and stop the worker, waiting at most `timeout` seconds (default SLACK_FLUSH_TIMEOUT,
+        capped by the remaining time of the Lambda `context`); returns True when every event was sent"""
+
+        timeout = SLACK_FLUSH_TIMEOUT if timeout is None else timeout
+        if context is not None:
+            remaining = context.get_remaining_time_in_millis() / 1000.0 - FLUSH_MARGIN_SECONDS
+            timeout = max(0.0, min(timeout, remaining))
+
+        self.events.put(_FLUSH)
+        self.worker.join(timeout)
+        if self.worker.is_alive():
+            logger.warning(f"S3-SFTP: Slack notifications not sent within {timeout:.1f}s, giving up on them")
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            event = self.events.get()
+            if event is _FLUSH:
+                return
+            batch = [event]
+            stop = self._collect(batch)
+            self._send(batch)
+            if stop:
+                return
+
+    def _collect(self, batch):
+        """Add the events arriving within the summary window to batch; True when a flush was requested"""
+
+        deadline = time.monotonic() + self.summary_seconds
+        while True:
+            try:
+                event = self.events.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return False
+            if event is _FLUSH:
+                # Everything queued before the flush is already in the batch
+                return True
+            batch.append(event)
+
+    def _send(self, batch):
+        try:
+            self.send(summarize(batch, self.pretty_time()), self.channel)
+            self.sent += len(batch)
+        except Exception:
+            logger.exception(f"S3-SFTP: Unable to send {len(batch)} Slack notification(s)")
@@ -0,0 +1,157 @@
+import heapq
+import threading
+import time
+
+import pytest
+
+import adaptive_concurrency
+from adaptive_concurrency import AdaptiveConcurrency, ERROR, OK, THROTTLED, TimeBudgetExceeded
+
+
+def simulate(controller, service, completions):
+    """Drive the controller on a virtual clock: keep `window` calls in flight against service(in_flight, now), which
+    returns (latency, outcome). Returns [(now, window, outcome)] per completion"""
+
+    now = [controller.clock()]
+    controller.clock = lambda: now[0]
+    pending = []
+    in_flight = 0
+    trace = []
+    for sequence in range(completions):
+        while in_flight < controller.window:
+            in_flight += 1
+            latency, outcome = service(in_flight, now[0])
+            heapq.heappush(pending, (now[0] + latency, sequence, latency, outcome))
+        now[0], _, latency, outcome = heapq.heappop(pending)
+        in_flight -= 1
+        controller.on_complete(latency, outcome)
+        trace.append((now[0], controller.window, outcome))
+    return trace
+
+
+def queueing(capacity, base=0.05):
+    # Past `capacity` calls in flight, every call waits its share
+    return lambda in_flight, now: (base * max(1.0, in_flight / capacity), OK)
+
+
+def throttling(capacity, base=0.05):
+    # Past `capacity` calls in flight the service answers 429 straight away
+    return lambda in_flight, now: (base, OK) if in_flight <= capacity else (base / 10, THROTTLED)
+
+
+def ok_per_second(trace):
+    start, end = trace[0][0], trace[-1][0]
+    return sum(1 for now, window, outcome in trace if outcome == OK) / (end - start)
+
+
+def test_converges_on_latency():
+    controller = AdaptiveConcurrency('queueing', maximum=64)
+    trace = simulate(controller, queueing(capacity=8), 4000)[2000:]
+
+    windows = [window for now, window, outcome in trace]
+    # The window saws between the capacity and the latency tolerance, never running away to the maximum
+    assert 4 <= min(windows) and max(windows) <= 17
+    assert ok_per_second(trace) >= 0.9 * 8 / 0.05
+
+
+def test_converges_on_throttling():
+    controller = AdaptiveConcurrency('throttling', maximum=64)
+    trace = simulate(controller, throttling(capacity=6), 4000)[2000:]
+
+    windows = [window for now, window, outcome in trace]
+    assert 3 <= min(windows) and max(windows) <= 7
+    # Probing past the limit costs about one throttle per sawtooth
+    assert sum(1 for now, window, outcome in trace if outcome == THROTTLED) < 0.15 * len(trace)
+    assert ok_per_second(trace) >= 0.7 * 6 / 0.05
+
+
+def test_follows_a_capacity_drop():
+    capacity = [12]
+    service = lambda in_flight, now: throttling(capacity[0])(in_flight, now)
+    controller = AdaptiveConcurrency('drop', maximum=64)
+
+    simulate(controller, service, 2000)
+    assert controller.window >= 6
+    capacity[0] = 3
+    trace = simulate(controller, service, 2000)[1000:]
+    assert max(window for now, window, outcome in trace) <= 4
+
+
+def test_respects_the_hard_cap_and_backs_off_on_errors():
+    controller = AdaptiveConcurrency('capped', maximum=4)
+    trace = simulate(controller, queueing(capacity=100), 500)
+    assert max(window for now, window, outcome in trace) == 4
+
+    controller.on_complete(0.05, ERROR)
+    assert controller.window == 2
+
+
+def test_without_latency_tolerance_big_items_do_not_shrink_the_window():
+    # Operations as long as their item is big: one in ten takes 50x the others, whatever is in flight
+    sizes = iter(range(10 ** 6))
+    service = lambda in_flight, now: (0.05 * (50 if next(sizes) % 10 == 0 else 1), OK)
+
+    # With the latency signal every big item reads as congestion and halves the window
+    assert min(window for now, window, outcome in simulate(AdaptiveConcurrency('latency', maximum=8), service,
+                                                            500)[250:]) <= 4
+    trace = simulate(AdaptiveConcurrency('sizes', maximum=8, latency_tolerance=None), service, 500)[250:]
+    assert min(window for now, window, outcome in trace) == 8
+
+    controller = AdaptiveConcurrency('sizes', maximum=8, initial=8, latency_tolerance=None)
+    controller.on_complete(0.05, THROTTLED)
+    assert controller.window == 4
+
+
+def test_map_keeps_order_classifies_and_caps_threads():
+    controller = AdaptiveConcurrency('threads', maximum=3, initial=3)
+    running, peak, lock = [0], [0], threading.Lock()
+
+    class SlowDown(Exception):
+        response = {'Error': {'Code': 'SlowDown'}}
+
+    def call(item):
+        with lock:
+            running[0] += 1
+            peak[0] = max(peak[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        if item == 5:
+            raise SlowDown()
+        return item * 2
+
+    outcomes = controller.map(call, range(10))
+
+    assert [result for result, error in outcomes] == [0, 2, 4, 6, 8, None, 12, 14, 16, 18]
+    assert isinstance(outcomes[5][1], SlowDown)
+    assert controller.completed[THROTTLED] == 1
+    assert peak[0] <= 3
+
+
+def test_map_stops_starting_work_when_time_runs_out():
+    class Context:
+        remaining_ms = 20000
+
+        def get_remaining_time_in_millis(self):
+            return self.remaining_ms
+
+    context = Context()
+
+    def call(item):
+        context.remaining_ms -= 6000
+        return item
+
+    controller = AdaptiveConcurrency('budget', maximum=1, context=context, reserve_seconds=5.0)
+    outcomes = controller.map(call, range(5))
+
+    assert [result for result, error in outcomes[:3]] == [0, 1, 2]
+    assert all(isinstance(error, TimeBudgetExceeded) for result, error in outcomes[3:])
+
+
+@pytest.mark.parametrize('message, expected', [
+    ('429 Client Error: Too Many Requests for url', THROTTLED),
+    ('There was an error while reading the json file x: An error occurred (SlowDown)', THROTTLED),
+    ('There was an error copying  file  inbox/x.json', ERROR),
+])
+def test_classify_exception(message, expected):
+    assert adaptive_concurrency.classify_exception(Exception(message)) == expected
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from bench_import_time import HANDLERS, measure
+
+# Dependencies only some code paths need; importing a handler must not load them
+DEFERRED = {
+    'Inquiry_pool_File_watcher': ['pyodbc', 'pytz', 'smb'],
+    'delivery_scheduler': ['smart_open'],
+    's3-sftp': ['nsc_config', 'nsc_helpers', 'nsc_time', 'paramiko'],
+    'you_visit_api': ['requests', 'psycopg2', 'pyarrow'],
+}
+
+
+# Stand-ins for the NSC layer modules s3-sftp imports, as pipeline_simulator.load_s3_sftp builds them. The real
+# nsc_config fetches the secrets as it is imported; a handler that imported it early shows up in DEFERRED rather than
+# failing for want of the layer
+NSC_LAYER = {
+    'nsc_config': "secrets = {'host': '127.0.0.1', 'port': 22, 'username': 'nsc', 'password': 'secret', "
+                  "'upload_dir': '/'}\nnsc_log_channel = '#test'\n",
+    'nsc_helpers': "def send_to_slack(message, channel):\n    pass\n",
+    'nsc_time': "def pretty_time():\n    return ''\n",
+}
+
+
+def handler_env(layer_dir):
+    # No credentials or queue URL: an import that reached out to AWS would fail
+    env = {k: v for k, v in os.environ.items() if not k.startswith('AWS_') and k != 'IPFilePathQueue_URL'}
+    env['AWS_DEFAULT_REGION'] = 'us-east-1'
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(layer_dir), env.get('PYTHONPATH')]))
+    return env
+
+
+@pytest.fixture
+def nsc_layer(tmp_path):
+    for name, source in NSC_LAYER.items():
+        (tmp_path / f"{name}.py").write_text(source)
+    return tmp_path
+
+
+@pytest.mark.parametrize('handler', sorted(DEFERRED))
+def test_handler_import_defers_heavy_modules(handler, nsc_layer):
+    total, modules = measure(HANDLERS[handler], env=handler_env(nsc_layer))
+    loaded = sorted({name.split('.')[0] for name in modules} & set(DEFERRED[handler]))
+
+    assert loaded == [], f"{handler} imports {loaded} at import time ({total / 1000:.1f} ms)"
@@ -0,0 +1,55 @@
+import json
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import lambda_metrics
+
+
+def emf_records(capsys):
+    return [json.loads(line) for line in capsys.readouterr().out.splitlines() if line.startswith('{"_aws"')]
+
+
+@mock_aws
+def test_instrument_counts_aws_calls_and_bytes(capsys):
+    s3 = boto3.client('s3', region_name='us-east-1')
+    s3.create_bucket(Bucket='metrics-test')
+
+    @lambda_metrics.instrument('test_handler')
+    def handler(event, context):
+        s3.put_object(Bucket='metrics-test', Key='a.txt', Body=b'12345')
+        s3.get_object(Bucket='metrics-test', Key='a.txt')['Body'].read()
+        lambda_metrics.record('SFTP', 5, seconds=0.25)
+        return 'done'
+
+    assert handler({}, None) == 'done'
+
+    [record] = emf_records(capsys)
+    definition = record['_aws']['CloudWatchMetrics'][0]
+    assert definition['Dimensions'] == [['Function']]
+    assert {metric['Name'] for metric in definition['Metrics']} == \
+        {'Latency', 'MaxRSS', 'Error', 'S3Calls', 'S3Bytes', 'S3Time', 'SFTPCalls', 'SFTPBytes', 'SFTPTime'}
+    assert record['Function'] == 'test_handler'
+    assert record['Error'] == 0
+    assert record['S3Calls'] == 2
+    assert record['S3Bytes'] == 10
+    assert record['S3Time'] > 0
+    assert record['SFTPCalls'] == 1
+    assert record['SFTPTime'] == 250.0
+
+
+def test_instrument_emits_on_exit(capsys):
+
+    @lambda_metrics.instrument('failing_handler')
+    def handler(event, context):
+        tracked = lambda_metrics.track(['row'], 'SQL', ('copy',))
+        tracked.copy()
+        exit(1)
+
+    with pytest.raises(SystemExit):
+        handler({}, None)
+
+    [record] = emf_records(capsys)
+    assert record['Error'] == 1
+    assert record['SQLCalls'] == 1
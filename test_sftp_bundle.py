@@ -0,0 +1,81 @@
+import datetime
+import tarfile
+
+import boto3
+import paramiko
+import pytest
+from moto import mock_aws
+
+import sftp_bundle
+import sftp_transfer
+from local_sftp_server import LocalSFTPServer
+
+BUCKET = 'nsc-outbound'
+PREFIX = 'nsc/'
+
+
+@pytest.fixture
+def endpoints(tmp_path):
+    """(sftp_client, s3_client, remote root)"""
+
+    with mock_aws(), LocalSFTPServer(str(tmp_path), 'nsc', 'secret') as server:
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket=BUCKET)
+        transport = sftp_transfer.open_transport('127.0.0.1', server.port, 'nsc', 'secret')
+        try:
+            yield paramiko.SFTPClient.from_transport(transport), s3_client, tmp_path
+        finally:
+            transport.close()
+
+
+def bundled_keys(path):
+    with tarfile.open(path, 'r:gz') as archive:
+        return sorted(name for name in archive.getnames() if name != 'MANIFEST.json')
+
+
+def run(sftp_client, s3_client):
+    # The window just closed: everything put so far was modified before its end
+    start, end = sftp_bundle.window_bounds(datetime.datetime.now(datetime.timezone.utc)
+                                           + datetime.timedelta(seconds=sftp_bundle.SFTP_BUNDLE_WINDOW_SECONDS))
+    return sftp_bundle.send_bundle(sftp_client, s3_client, BUCKET, PREFIX, start, end, bundle_format='tar.gz')
+
+
+def test_every_undelivered_object_goes_out_once(endpoints):
+    sftp_client, s3_client, root = endpoints
+    for name in ('a.json', 'b.json'):
+        s3_client.put_object(Bucket=BUCKET, Key=PREFIX + name, Body=b'{}')
+    s3_client.put_object(Bucket=BUCKET, Key=PREFIX + 'big.dat',
+                         Body=b'x' * (sftp_bundle.SFTP_BUNDLE_MAX_OBJECT_BYTES + 1))
+
+    assert run(sftp_client, s3_client)['count'] == 2
+    first, = root.glob('nsc-bundle-*.tar.gz')
+    assert bundled_keys(first) == ['nsc/a.json', 'nsc/b.json']
+
+    # Nothing new: a later run (or a retry of this one) sends nothing again
+    assert run(sftp_client, s3_client) is None
+
+    # An object that missed its own window's run goes out with the next bundle, alone
+    s3_client.put_object(Bucket=BUCKET, Key=PREFIX + 'late.json', Body=b'{}')
+    assert run(sftp_client, s3_client)['count'] == 1
+    second, = set(root.glob('nsc-bundle-*.tar.gz')) - {first}
+    assert bundled_keys(second) == ['nsc/late.json']
+
+
+def test_a_bundle_already_in_place_only_tags_its_objects(endpoints, monkeypatch):
+    sftp_client, s3_client, root = endpoints
+    s3_client.put_object(Bucket=BUCKET, Key=PREFIX + 'a.json', Body=b'{}')
+    # The first attempt gets the bundle in place, then dies before tagging
+    monkeypatch.setattr(sftp_bundle, 'mark_bundled', lambda *args: None)
+    run(sftp_client, s3_client)
+    monkeypatch.undo()
+
+    assert run(sftp_client, s3_client) is None
+    assert len(list(root.glob('nsc-bundle-*.tar.gz'))) == 1
+    assert sftp_bundle.list_undelivered_objects(s3_client, BUCKET, PREFIX, datetime.datetime.min.replace(
+        tzinfo=datetime.timezone.utc), datetime.datetime.max.replace(tzinfo=datetime.timezone.utc)) == []
+
+
+@pytest.mark.parametrize('value', ['2021-01-05T10:15:00', '2021-01-05T10:15:00Z', '2021-01-05T11:15:00+01:00'])
+def test_window_start_is_read_as_utc(value):
+    assert sftp_bundle.parse_window_start(value) == datetime.datetime(2021, 1, 5, 10, 15,
+                                                                      tzinfo=datetime.timezone.utc)
@@ -0,0 +1,109 @@
+import os
+
+import boto3
+import paramiko
+import pytest
+from moto import mock_aws
+
+import sftp_transfer
+from local_sftp_server import LocalSFTPServer
+
+BUCKET = 'nsc-outbound'
+KEY = 'clearinghouse.dat'
+
+
+@pytest.mark.parametrize('memory_mb, channels', [(128, 1), (128, 4), (256, 4), (1024, 8)])
+def test_range_settings_keep_all_channels_within_the_budget(monkeypatch, memory_mb, channels):
+    monkeypatch.setattr(sftp_transfer, 'SFTP_TRANSFER_MEMORY', memory_mb * 1024 * 1024 // 4)
+
+    range_size, concurrency = sftp_transfer.range_settings(channels)
+
+    held = channels * ((concurrency + 1) * range_size + sftp_transfer.SFTP_BUFFER_SIZE)
+    assert held <= sftp_transfer.SFTP_TRANSFER_MEMORY
+    assert range_size % sftp_transfer.MIN_RANGE_SIZE == 0
+
+
+def test_range_settings_honour_explicit_sizes(monkeypatch):
+    monkeypatch.setattr(sftp_transfer, 'S3_RANGE_SIZE', 8 * 1024 * 1024)
+    monkeypatch.setattr(sftp_transfer, 'S3_RANGE_CONCURRENCY', 2)
+
+    assert sftp_transfer.range_settings(4) == (8 * 1024 * 1024, 2)
+
+
+@pytest.fixture
+def endpoints(tmp_path, monkeypatch):
+    """(sftp_client, s3_client, remote root) with several ranges per object"""
+
+    monkeypatch.setattr(sftp_transfer, 'S3_RANGE_SIZE', 256 * 1024)
+    with mock_aws(), LocalSFTPServer(str(tmp_path), 'nsc', 'secret') as server:
+        s3_client = boto3.client('s3', region_name='us-east-1')
+        s3_client.create_bucket(Bucket=BUCKET)
+        transport = sftp_transfer.open_transport('127.0.0.1', server.port, 'nsc', 'secret')
+        try:
+            yield paramiko.SFTPClient.from_transport(transport), s3_client, tmp_path
+        finally:
+            transport.close()
+
+
+def etag_of(s3_client):
+    return s3_client.head_object(Bucket=BUCKET, Key=KEY)['ETag'].strip('"')
+
+
+def test_deliver_transfers_skips_and_resumes(endpoints):
+    sftp_client, s3_client, root = endpoints
+    payload = os.urandom(1024 * 1024 + 123)
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=payload)
+
+    assert sftp_transfer.deliver(sftp_client, s3_client, BUCKET, KEY, KEY) == 'TRANSFERRED'
+    assert (root / KEY).read_bytes() == payload
+    assert sftp_transfer.delivered_etag(s3_client, BUCKET, KEY) == etag_of(s3_client)
+
+    # A redelivered event finds the same size and ETag and sends nothing
+    assert sftp_transfer.deliver(sftp_client, s3_client, BUCKET, KEY, KEY) == 'SKIPPED'
+
+    # An upload interrupted 300000 bytes in carries on from the part file
+    (root / KEY).unlink()
+    part = root / sftp_transfer.temporary_name(KEY, etag_of(s3_client))
+    part.write_bytes(payload[:300000])
+
+    assert sftp_transfer.deliver(sftp_client, s3_client, BUCKET, KEY, KEY) == 'RESUMED'
+    assert (root / KEY).read_bytes() == payload
+    assert not part.exists()
+
+
+def test_deliver_sends_a_changed_object_again(endpoints):
+    sftp_client, s3_client, root = endpoints
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=b'a' * 700000)
+    assert sftp_transfer.deliver(sftp_client, s3_client, BUCKET, KEY, KEY) == 'TRANSFERRED'
+    old_etag = etag_of(s3_client)
+
+    # Same size, different content, still tagged with the old delivery: only the ETag tells them apart
+    changed = b'b' * 700000
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=changed,
+                         Tagging=f"{sftp_transfer.DELIVERED_ETAG_TAG}={old_etag}")
+    assert etag_of(s3_client) != old_etag
+    assert sftp_transfer.delivered_etag(s3_client, BUCKET, KEY) == old_etag
+
+    assert sftp_transfer.deliver(sftp_client, s3_client, BUCKET, KEY, KEY) == 'TRANSFERRED'
+    assert (root / KEY).read_bytes() == changed
+    assert sftp_transfer.delivered_etag(s3_client, BUCKET, KEY) == etag_of(s3_client)
+
+
+def test_deliver_fails_when_the_object_changes_mid_transfer(endpoints, monkeypatch):
+    from botocore.exceptions import ClientError
+    sftp_client, s3_client, root = endpoints
+    s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=b'a' * 700000)
+    head_object = s3_client.head_object
+
+    # Overwritten with the same size right after deliver() read the ETag
+    def head_then_overwrite(**kwargs):
+        head = head_object(**kwargs)
+        s3_client.put_object(Bucket=BUCKET, Key=KEY, Body=b'b' * 700000)
+        return head
+
+    monkeypatch.setattr(s3_client, 'head_object', head_then_overwrite)
+    with pytest.raises(ClientError, match='PreconditionFailed'):
+        sftp_transfer.deliver(sftp_client, s3_client, BUCKET, KEY, KEY)
+
+    assert not (root / KEY).exists()
+    assert sftp_transfer.delivered_etag(s3_client, BUCKET, KEY) is None
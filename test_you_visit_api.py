@@ -0,0 +1,272 @@
+import csv
+import datetime
+import glob
+import gzip
+import json
+import os
+
+import pytest
+
+import you_visit_api
+from you_visit_simulator import TenantSpec, YouVisitSimulator, FakePantoDatabase
+
+TENANT = 'resume-tenant'
+MEMBER_SK = '3200'
+
+
+@pytest.fixture
+def local_pull(monkeypatch):
+    # Files stay local and the quota does not slow the test down
+    monkeypatch.setattr(you_visit_api, 'in_aws', False)
+    monkeypatch.setattr(you_visit_api, 'api_rate_limiter', you_visit_api.RateLimiter(100000))
+    database = FakePantoDatabase()
+    with YouVisitSimulator([TenantSpec(TENANT, 3200)], requests_per_minute=100000) as simulator:
+        yield database, simulator
+
+
+def pull(database, simulator, create_date_time, workdir, monkeypatch):
+    """One invocation's worth of work for the tenant; returns its process log row"""
+
+    os.makedirs(workdir)
+    monkeypatch.chdir(workdir)
+    database.launch(MEMBER_SK, create_date_time)
+    process_log = you_visit_api.ProcessLog(database.connect())
+    run = you_visit_api.parse_message(
+        f"00000|token|{simulator.url_for(TENANT)}|{create_date_time}|{TENANT}|{MEMBER_SK}")
+    you_visit_api.run_tenant(run, process_log, process_log.start_points([run])[run])
+    process_log.flush()
+    return database.status_of(MEMBER_SK, create_date_time)
+
+
+def exported_ids(workdir):
+    ids = []
+    for path in glob.glob(os.path.join(workdir, '*.txt')):
+        with open(path, encoding='utf-8') as export:
+            reader = csv.reader(export, delimiter='|')
+            header = next(reader)
+            ids.extend(row[header.index('id')] for row in reader)
+    return ids
+
+
+def test_partial_pull_resumes_without_duplicates(local_pull, tmp_path, monkeypatch):
+    database, simulator = local_pull
+    respond = simulator.respond
+    calls = []
+
+    # The 4th call (recon, then pages 0-1 succeed) is answered with a 503, so the first run stops at offset 1000
+    def failing_respond(path, query):
+        calls.append(query)
+        return (503, {'error': 'injected failure'}) if len(calls) == 4 else respond(path, query)
+
+    monkeypatch.setattr(simulator, 'respond', failing_respond)
+    first = pull(database, simulator, '2021-01-02 06:00:00', str(tmp_path / 'first'), monkeypatch)
+    assert first['status_indicator'] == 'PARTIAL'
+    assert first['last_offset'] == 1000
+    assert first['no_of_rows_in_file'] == 1000
+
+    second = pull(database, simulator, '2021-01-03 06:00:00', str(tmp_path / 'second'), monkeypatch)
+    assert second['status_indicator'] == 'SUCCESS'
+    # Recon, then paging restarts at the checkpoint
+    assert calls[5]['offset'] == ['1000']
+
+    ids = exported_ids(str(tmp_path / 'first')) + exported_ids(str(tmp_path / 'second'))
+    assert len(ids) == 3200
+    assert set(ids) == {str(i) for i in range(3200)}
+
+
+def test_resume_with_offset_creation_times_loses_nothing(local_pull, tmp_path, monkeypatch):
+    database, simulator = local_pull
+    # The API answers in +05:00; the watermark has to be kept as UTC, not as the local wall time
+    for record in simulator.tenants[TENANT][1]:
+        local = datetime.datetime.fromisoformat(record['creation_time']) + datetime.timedelta(hours=5)
+        record['creation_time'] = local.strftime('%Y-%m-%dT%H:%M:%S+05:00')
+    respond = simulator.respond
+    calls = []
+
+    def failing_respond(path, query):
+        calls.append(query)
+        return (503, {'error': 'injected failure'}) if len(calls) == 4 else respond(path, query)
+
+    monkeypatch.setattr(simulator, 'respond', failing_respond)
+    first = pull(database, simulator, '2021-01-02 06:00:00', str(tmp_path / 'first'), monkeypatch)
+    last_pulled = simulator.tenants[TENANT][1][999]['creation_time']
+    assert first['last_creation_time'] == str(you_visit_api.parse_creation_time(last_pulled))
+
+    pull(database, simulator, '2021-01-03 06:00:00', str(tmp_path / 'second'), monkeypatch)
+    ids = exported_ids(str(tmp_path / 'first')) + exported_ids(str(tmp_path / 'second'))
+    assert sorted(ids, key=int) == [str(i) for i in range(3200)]
+
+
+@pytest.mark.parametrize('value', ['2021-01-01 00:10:00', '2021-01-01T00:10:00', '2021-01-01T00:10:00Z',
+                                   '2021-01-01T05:10:00+05:00'])
+def test_parse_creation_time_reads_every_form(value):
+    watermark = you_visit_api.parse_creation_time('2021-01-01 00:10:00')
+    assert you_visit_api.parse_creation_time(value) == watermark
+
+
+@pytest.mark.parametrize('third_call', [
+    'connection error',
+    'no resources',
+    'unreadable page',
+])
+def test_failed_page_still_records_a_status(local_pull, tmp_path, monkeypatch, third_call):
+    import requests
+    database, simulator = local_pull
+    respond, get = simulator.respond, requests.get
+    calls = []
+
+    # Recon and page 0 succeed; the 3rd call (page 1) fails in one of the ways pull_data has to survive
+    def failing_get(url, **kwargs):
+        calls.append(url)
+        if len(calls) == 3 and third_call == 'connection error':
+            raise requests.ConnectionError('connection reset by peer')
+        return get(url, **kwargs)
+
+    def failing_respond(path, query):
+        if len(calls) == 3 and third_call == 'no resources':
+            return 200, {'resources': []}
+        if len(calls) == 3 and third_call == 'unreadable page':
+            return 200, {'resources': {'data': None}}
+        return respond(path, query)
+
+    monkeypatch.setattr(requests, 'get', failing_get)
+    monkeypatch.setattr(simulator, 'respond', failing_respond)
+    row = pull(database, simulator, '2021-01-02 06:00:00', str(tmp_path / 'run'), monkeypatch)
+
+    # Not left LAUNCHED: page 0 is exported and the next run resumes at page 1
+    assert row['status_indicator'] == 'PARTIAL'
+    assert row['no_of_rows_in_file'] == 500
+    assert row['last_offset'] == 500
+    assert sorted(exported_ids(str(tmp_path / 'run')), key=int) == [str(i) for i in range(500)]
+
+
+BUFFER = [['id', 'email'], ['1', 'a@x.org'], ['2', 'b@x.org'], ['3', 'multi|pipe'], ['4', ''], ['5', 'e@x.org']]
+
+
+@pytest.fixture
+def export_dir(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+def read_gz_part(path):
+    with gzip.open(path, mode='rt', encoding='utf-8', newline='') as part:
+        return list(csv.reader(part, delimiter='|'))
+
+
+def test_export_parts_splits_gz_parts_with_manifest(export_dir, monkeypatch):
+    monkeypatch.setattr(you_visit_api, 'output_format', 'gz')
+    monkeypatch.setattr(you_visit_api, 'output_part_rows', 2)
+
+    manifest = you_visit_api.export_parts('youvisit-inquiry-t-2021.txt', BUFFER, False, 'archive/t')
+
+    names = [f'youvisit-inquiry-t-2021-part-0000{n}.txt.gz' for n in (1, 2, 3)]
+    assert [part['key'] for part in manifest['parts']] == [f'archive/t/{name}' for name in names]
+    assert [part['rows'] for part in manifest['parts']] == [2, 2, 1]
+    assert manifest['total_rows'] == 5
+    assert manifest['columns'] == ['id', 'email']
+    assert [part['bytes'] for part in manifest['parts']] == [os.path.getsize(export_dir / n) for n in names]
+    # Every part repeats the header
+    rows = [read_gz_part(export_dir / name) for name in names]
+    assert all(part[0] == ['id', 'email'] for part in rows)
+    assert [row for part in rows for row in part[1:]] == BUFFER[1:]
+
+    with open(export_dir / 'youvisit-inquiry-t-2021.manifest.json', encoding='utf-8') as manifest_file:
+        assert json.load(manifest_file) == manifest
+
+
+def test_export_parts_single_part_keeps_the_stem(export_dir, monkeypatch):
+    monkeypatch.setattr(you_visit_api, 'output_format', 'gz')
+    monkeypatch.setattr(you_visit_api, 'output_part_rows', 0)
+
+    manifest = you_visit_api.export_parts('youvisit-inquiry-t-2021.txt', BUFFER, False, 'archive/t')
+
+    assert [part['key'] for part in manifest['parts']] == ['archive/t/youvisit-inquiry-t-2021.txt.gz']
+    assert read_gz_part(export_dir / 'youvisit-inquiry-t-2021.txt.gz') == BUFFER
+
+
+def test_export_parts_writes_an_empty_part_for_a_header_only_buffer(export_dir, monkeypatch):
+    monkeypatch.setattr(you_visit_api, 'output_format', 'txt')
+    monkeypatch.setattr(you_visit_api, 'output_part_rows', 2)
+
+    manifest = you_visit_api.export_parts('youvisit-inquiry-t-2021.txt', BUFFER[:1], False, 'archive/t')
+
+    assert manifest['total_rows'] == 0
+    assert [(part['key'], part['rows']) for part in manifest['parts']] == [('archive/t/youvisit-inquiry-t-2021.txt', 0)]
+
+
+def test_export_parts_parquet(export_dir, monkeypatch):
+    parquet = pytest.importorskip('pyarrow.parquet')
+    monkeypatch.setattr(you_visit_api, 'output_format', 'parquet')
+    monkeypatch.setattr(you_visit_api, 'output_part_rows', 3)
+
+    manifest = you_visit_api.export_parts('youvisit-inquiry-t-2021.txt', BUFFER, False, 'archive/t')
+
+    assert [part['rows'] for part in manifest['parts']] == [3, 2]
+    first = parquet.read_table(export_dir / 'youvisit-inquiry-t-2021-part-00001.parquet').to_pydict()
+    second = parquet.read_table(export_dir / 'youvisit-inquiry-t-2021-part-00002.parquet').to_pydict()
+    assert first == {'id': ['1', '2', '3'], 'email': ['a@x.org', 'b@x.org', 'multi|pipe']}
+    # Empty strings are written as nulls
+    assert second == {'id': ['4', '5'], 'email': [None, 'e@x.org']}
+
+
+def test_export_parts_rejects_an_unknown_format(export_dir, monkeypatch):
+    monkeypatch.setattr(you_visit_api, 'output_format', 'xlsx')
+
+    with pytest.raises(Exception, match='Unsupported OUTPUT_FORMAT xlsx'):
+        you_visit_api.export_parts('youvisit-inquiry-t-2021.txt', BUFFER, False, 'archive/t')
+
+
+def test_status_is_written_as_each_tenant_finishes(local_pull, tmp_path, monkeypatch):
+    import psycopg2
+    database, simulator = local_pull
+    monkeypatch.setattr(you_visit_api, 'in_aws', True)
+    monkeypatch.setattr(you_visit_api, 'upload_to_panto', lambda full_file_path, key: None)
+    monkeypatch.setattr(you_visit_api, 'connect_panto', lambda: (database.connect(), False))
+    monkeypatch.setattr(you_visit_api, 'max_concurrent_tenants', 1)
+
+    # The first tenant's write goes through; the database is gone for every write after it
+    bulk_status, writes = database._bulk_status, []
+
+    def failing_bulk_status(statement):
+        writes.append(statement)
+        if len(writes) > 1:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+        return bulk_status(statement)
+
+    monkeypatch.setattr(database, '_bulk_status', failing_bulk_status)
+    records = []
+    for message_id, member_sk in (('first', '1'), ('second', '2')):
+        database.launch(member_sk, '2021-01-02 06:00:00')
+        records.append({'messageId': message_id, 'body': f"00000|token|{simulator.url_for(TENANT)}|"
+                                                         f"2021-01-02 06:00:00|{TENANT}|{member_sk}"})
+
+    result = you_visit_api.main({'Records': records}, None)
+
+    # Only the tenant whose status never made it goes round again
+    assert result == {'batchItemFailures': [{'itemIdentifier': 'second'}]}
+    assert database.status_of('1', '2021-01-02 06:00:00')['status_indicator'] == 'SUCCESS'
+    assert len(writes) == 3
+
+
+def test_redelivered_batch_skips_tenants_already_pulled(local_pull, monkeypatch):
+    database, simulator = local_pull
+    uploads = []
+    monkeypatch.setattr(you_visit_api, 'in_aws', True)
+    monkeypatch.setattr(you_visit_api, 'upload_to_panto', lambda full_file_path, key: uploads.append(key))
+    monkeypatch.setattr(you_visit_api, 'connect_panto', lambda: (database.connect(), False))
+    records = {}
+    for message_id, member_sk in (('first', '1'), ('second', '2')):
+        database.launch(member_sk, '2021-01-02 06:00:00')
+        records[message_id] = {'messageId': message_id, 'body': f"00000|token|{simulator.url_for(TENANT)}|"
+                                                                f"2021-01-02 06:00:00|{TENANT}|{member_sk}"}
+
+    # The first tenant finished before the invocation timed out; SQS then delivers the whole batch again
+    assert you_visit_api.main({'Records': [records['first']]}, None) == {'batchItemFailures': []}
+    assert len(uploads) == 1
+    result = you_visit_api.main({'Records': list(records.values())}, None)
+
+    assert result == {'batchItemFailures': []}
+    assert len(uploads) == 2
+    assert database.status_of('1', '2021-01-02 06:00:00')['status_indicator'] == 'SUCCESS'
+    assert database.status_of('2', '2021-01-02 06:00:00')['status_indicator'] == 'SUCCESS'
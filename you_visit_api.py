@@ -1,18 +1,30 @@
 ''' Pulls data from the YouVisit API for a given client; writes the results to  S3 bucket.
 
+A PARTIAL run checkpoints the offset_start_date (date), last_offset (integer) and last_creation_time (timestamp)
+columns of panto.you_visit_process_log; the next run for that member resumes from the checkpoint instead of refetching
+the day. The columns have to exist before this version is deployed - see the ALTER TABLE in the README.
+All process log reads and writes of an invocation go through one ProcessLog (one connection, one start point query,
+and an execute_values of the status changes queued so far each time a tenant finishes).
+
+requests and psycopg2 are imported by the functions that use them, so importing the module (cold start, the
+simulator, tests) does not load them.
 
 '''
 
-import requests
 import csv
+import gzip
+import json
 import os
 import boto3 as boto
 import datetime
+import functools
 import logging 
 import math
+import threading
 import time
-import psycopg2
-import psycopg2.extras
+import adaptive_concurrency
+import lambda_metrics
+import s3_io
 from datetime import date 
 
 # Setup
@@ -22,60 +34,217 @@ api_record_limit = int(os.getenv('API_RECORD_LIMIT', 500))
 #                 "update_time", "street", "city", "state", "postal", "country", "phone", "graduation_year", "major", "school",
 #                 "school_ceeb_code", "userkey", "source", "visitor_type", "enroll_year", "enroll_term", "is_cif", "full_registration"]
 
-# The API is throttled to 100 requests/minute.
-delay = int(os.getenv('API_DELAY_SECONDS', 5))
+# The API is throttled to 100 requests/minute. The limiter only sees this container, so the quota is split evenly
+# across API_CONTAINERS, the most containers that can pull at once; cap the function at that many (reserved
+# concurrency, or the SQS event source's MaximumConcurrency) - see the README
+api_requests_per_minute = int(os.getenv('API_REQUESTS_PER_MINUTE', 100))
+api_containers = int(os.getenv('API_CONTAINERS', 1))
+# Upper bound on the tenants of one SQS batch that are pulled at the same time; within it the number adapts to how long
+# tenants take (quota waits included) - see adaptive_concurrency
+max_concurrent_tenants = int(os.getenv('MAX_CONCURRENT_TENANTS', 10))
 
 # Logging
 logger = logging.getLogger('custom_log_stat')
 logger.setLevel(logging.DEBUG)
 
-sql_success = """Update panto.you_visit_process_log l 
-                               set status_indicator = 'SUCCESS' ,
-                               no_of_rows_in_file = %s    
-                               where status_indicator = 'LAUNCHED: Message passed on to SQS Queue' 
-                               and mbr_sk= %s  
-                               and create_start_date = %s""" 
-
-sql_partial = """Update panto.you_visit_process_log l 
-                               set status_indicator = 'PARTIAL' ,
-                               no_of_rows_in_file = %s,
-                               create_start_date = %s,
-                               error_decription = 'API hit successful but not all records pulled'
-                               where status_indicator = 'LAUNCHED: Message passed on to SQS Queue' 
-                               and mbr_sk= %s  
-                               and create_start_date = %s""" 
-                               
-sql_zero_rows = """Update panto.you_visit_process_log l 
-                               set status_indicator = 'COMPLETED WITH ERROR' ,
-                               no_of_rows_in_file = 0 ,
-                               error_decription = 'API hit successful but unable to retrieve any records'
-                               where status_indicator = 'LAUNCHED: Message passed on to SQS Queue' 
-                               and mbr_sk= %s
-                               and create_start_date = %s"""    
-                                     
-sql_failed =   """Update panto.you_visit_process_log l 
-                               set status_indicator = 'FAILED' ,
-                               no_of_rows_in_file = 0 ,
-                               error_decription = %s
-                               where status_indicator = 'LAUNCHED: Message passed on to SQS Queue' 
-                               and mbr_sk= %s
-                               and create_start_date = %s""" 
-
-
-sql_default_start_time =   """select count(*) from panto.you_visit_process_log   
-                            where mbr_sk = %s and (status_indicator ='SUCCESS' or status_indicator = 'PARTIAL')"""          
-
-sql_start_time = """SELECT  MAX(date(create_start_date))  
-                    from panto.you_visit_process_log  where mbr_sk = %s and (status_indicator ='SUCCESS' or status_indicator = 'PARTIAL')"""                    
+# Where each message's pull starts, for the whole batch at once - one row per message, by its position in the batch.
+# launched says whether the message's own row is still LAUNCHED; once it is not, an earlier delivery of the message
+# already pulled the tenant. The latest SUCCESS/PARTIAL row carries the checkpoint of a PARTIAL run (the startDate it
+# paged from, the offset of the first page it did not commit and the creation_time of the last record it wrote); the
+# window MAX gives the day of the last pull for members that finished cleanly.
+# mbr_sk is compared against parameters cast to its (bigint) type, never the other way round, so its index is used
+sql_start_points = """SELECT b.position,
+                             exists(select 1 from panto.you_visit_process_log l
+                                    where l.mbr_sk = b.mbr_sk and l.create_start_date = b.create_start_date
+                                    and l.status_indicator = 'LAUNCHED: Message passed on to SQS Queue') as launched,
+                             p.status_indicator, p.offset_start_date, p.last_offset, p.last_creation_time, p.last_pull
+                      from unnest(%s::bigint[], %s::timestamp[]) with ordinality as b (mbr_sk, create_start_date, position)
+                      left join lateral (select status_indicator, offset_start_date, last_offset, last_creation_time,
+                                                MAX(date(create_start_date)) OVER () as last_pull
+                                         from panto.you_visit_process_log
+                                         where mbr_sk = b.mbr_sk
+                                         and (status_indicator ='SUCCESS' or status_indicator = 'PARTIAL')
+                                         order by create_start_date desc limit 1) p on true"""
+
+# Status changes queued by the tenants, applied with execute_values. The checkpoint and error columns are only
+# overwritten when the new status carries a value for them. Every VALUES column is cast to the type of the column it
+# is written to or compared with - an uncast literal or NULL in VALUES is text
+sql_status_bulk = """Update panto.you_visit_process_log l 
+                               set status_indicator = v.status_indicator ,
+                               no_of_rows_in_file = v.no_of_rows_in_file ,
+                               error_decription = coalesce(v.error_decription, l.error_decription) ,
+                               offset_start_date = coalesce(v.offset_start_date, l.offset_start_date) ,
+                               last_offset = coalesce(v.last_offset, l.last_offset) ,
+                               last_creation_time = coalesce(v.last_creation_time, l.last_creation_time)
+                               from (values %s) as v (status_indicator, no_of_rows_in_file, error_decription,
+                                                      offset_start_date, last_offset, last_creation_time,
+                                                      mbr_sk, create_start_date)
+                               where l.status_indicator = 'LAUNCHED: Message passed on to SQS Queue' 
+                               and l.mbr_sk = v.mbr_sk
+                               and l.create_start_date = v.create_start_date"""
+
+sql_status_template = "(%s, %s::integer, %s::text, %s::date, %s::integer, %s::timestamp, %s::bigint, %s::timestamp)"
+
+class RateLimiter:
+    """Spaces API calls evenly so every thread together stays under requests_per_minute"""
+
+    def __init__(self, requests_per_minute):
+        self.interval = 60.0 / requests_per_minute
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+            lambda_metrics.record('APIQuotaWait', seconds=slot - now)
+
+
+api_rate_limiter = RateLimiter(api_requests_per_minute / max(1, api_containers))
+
+
+class TenantRun:
+    """State of one tenant's pull - kept per SQS record so tenants in the same batch never share buffers"""
+
+    def __init__(self, partner_id, auth_token, url, create_date_time, tenant_guid, member_sk):
+        self.partner_id = partner_id
+        self.auth_token = auth_token
+        self.url = url
+        self.create_date_time = create_date_time
+        self.tenant_guid = tenant_guid
+        self.member_sk = member_sk
+        self.output_buffer = []
+        self.offset_start_date = None
+        self.committed_offset = 0
+
+
+# Event/Context Parsing
+# !- If no date, remove date parameter from URL
+# ! - Expect the following: PARTNER_ID|AUTH_TOKEN|URL|DATE_LAST_PULLED|PANTO_TENANT_GUID|MEMBER_SK
+def parse_message(body):
+    payload = body.replace("('", "").replace("',)", "")
+    partner_id, auth_token, url, create_date_time, tenant_guid, member_sk = payload.split('|')
+    member_sk = member_sk.replace("']","")
+    return TenantRun(partner_id, auth_token, url, create_date_time, tenant_guid, member_sk)
+
+# Output layout: txt (pipe delimited, the default), gz (gzip compressed txt) or parquet. With OUTPUT_PART_ROWS set the
+# rows are split into part files of at most that many rows; anything other than a single txt file also gets a manifest
+output_format = os.getenv('OUTPUT_FORMAT', 'txt')
+output_part_rows = int(os.getenv('OUTPUT_PART_ROWS', 0))
+output_extensions = {'txt': '.txt', 'gz': '.txt.gz', 'parquet': '.parquet'}
+
+class ProcessLog:
+    """panto.you_visit_process_log for one invocation. Holds a single connection, reads the start point of every
+    tenant in the batch with one query and queues status changes from the tenant threads until flush()"""
+
+    def __init__(self, con):
+        self.con = con
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.pending = []
+        self.written = set()
+
+    def start_points(self, runs):
+        """Return {run: (start_date, offset, watermark)}, or {run: None} when the run's LAUNCHED row has already been
+        settled by an earlier delivery of its message. A PARTIAL run with a checkpoint is resumed from the offset and
+        creation_time watermark it stopped at; otherwise we start from the day of the last pull"""
+
+        runs = list(runs)
+        cur = lambda_metrics.track(self.con.cursor(), 'SQL', ('execute',))
+        try:
+            cur.execute(sql_start_points, ([str(run.member_sk) for run in runs],
+                                           [run.create_date_time for run in runs]))
+            rows = {int(row[0]): row for row in cur.fetchall()}
+            # Don't sit idle in a transaction while the tenants are pulled
+            self.con.commit()
+        finally:
+            cur.close()
+
+        start_points = {}
+        for position, run in enumerate(runs, start=1):
+            launched, status_indicator, offset_start_date, last_offset, last_creation_time, last_pull = \
+                rows[position][1:]
+            if not launched:
+                start_points[run] = None
+            elif status_indicator is None:
+                start_points[run] = ("1900-01-01", 0, None)
+            elif status_indicator == 'PARTIAL' and last_offset is not None:
+                logger.info(f"INFO: Resuming PARTIAL pull for {run.member_sk} from startDate {offset_start_date}, "
+                            f"offset {last_offset}, watermark {last_creation_time}")
+                start_points[run] = (offset_start_date, int(last_offset), last_creation_time)
+            else:
+                start_points[run] = (last_pull, 0, None)
+        return start_points
+
+    def success(self, run, no_of_rows_in_file):
+        self._queue(run, 'SUCCESS', no_of_rows_in_file)
+
+    def partial(self, run, no_of_rows_in_file, most_recent):
+        # The watermark goes into a timestamp column as naive UTC; Postgres would drop an offset, not convert it
+        self._queue(run, 'PARTIAL', no_of_rows_in_file, 'API hit successful but not all records pulled',
+                    run.offset_start_date, run.committed_offset, parse_creation_time(most_recent))
+
+    def zero_rows(self, run):
+        self._queue(run, 'COMPLETED WITH ERROR', 0, 'API hit successful but unable to retrieve any records')
+
+    def failed(self, run, error_decription):
+        self._queue(run, 'FAILED', 0, error_decription)
+
+    def flush(self):
+        """Write every queued status change in one statement; returns the runs that were written. Flushes from
+        several threads take turns, so changes queued during one go out together with the next; a flush that fails
+        keeps its changes queued"""
+
+        import psycopg2
+        import psycopg2.extras
+
+        with self.write_lock:
+            with self.lock:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return []
+
+            cur = lambda_metrics.track(self.con.cursor(), 'SQL', ('execute',))
+            try:
+                psycopg2.extras.execute_values(cur, sql_status_bulk, [values for run, values in pending],
+                                               template=sql_status_template)
+                self.con.commit()
+            except psycopg2.Error:
+                self.con.rollback()
+                with self.lock:
+                    self.pending = pending + self.pending
+                raise
+            finally:
+                cur.close()
+            self.written.update(run for run, values in pending)
+        logger.info(f"INFO: {len(pending)} status changes written to you_visit_process_log")
+        return [run for run, values in pending]
+
+    def close(self):
+        self.con.close()
+
+    def _queue(self, run, status_indicator, no_of_rows_in_file, error_decription=None, offset_start_date=None,
+               last_offset=None, last_creation_time=None):
+        values = (status_indicator, no_of_rows_in_file, error_decription,
+                  None if offset_start_date is None else str(offset_start_date), last_offset,
+                  None if last_creation_time is None else str(last_creation_time),
+                  str(run.member_sk), run.create_date_time)
+        with self.lock:
+            self.pending.append((run, values))
 
 # CSV logic
 def csv_export(output_file, output_buffer, in_aws, key_slug):
-    if in_aws:
-        os.chdir('/tmp')
+    if output_format != 'txt' or output_part_rows > 0:
+        return export_parts(output_file, output_buffer, in_aws, key_slug)
+
     original_file_name = output_file
     full_file_path = '/tmp/' + output_file
     logger.info(f"INFO: FFN -> {full_file_path}")
-    with open(output_file, mode = "w", encoding='utf-8') as output_file:
+    # Tenants are exported from several threads, so write to an absolute path rather than chdir-ing the process
+    with open(full_file_path if in_aws else output_file, mode = "w", encoding='utf-8') as output_file:
         output_writer = csv.writer(output_file, delimiter = "|",
             quotechar = '"', quoting=csv.QUOTE_MINIMAL,
             lineterminator='\n')
@@ -84,16 +253,84 @@ def csv_export(output_file, output_buffer, in_aws, key_slug):
             output_writer.writerow(row)
 
     if in_aws == True:
-        # Now we push it to S3!
-        s3_connection = boto.resource('s3', region_name='us-east-1')
-        bucket = s3_connection.Bucket(os.environ["PANTO_BUCKET_NAME"])
-        key = f"{key_slug}/{original_file_name}"
-        logger.info(f"INFO: full_file_path -> {full_file_path}")
-        logger.info(f"INFO: key -> {key}")
-        bucket.upload_file(full_file_path, key)
+        upload_to_panto(full_file_path, f"{key_slug}/{original_file_name}")
+
+def upload_to_panto(full_file_path, key):
+    # Now we push it to S3! Tenants upload concurrently over the shared s3_io client
+    logger.info(f"INFO: full_file_path -> {full_file_path}")
+    logger.info(f"INFO: key -> {key}")
+    s3_io.upload_file(full_file_path, os.environ["PANTO_BUCKET_NAME"], key)
+
+# Write the buffer as OUTPUT_FORMAT part files plus a manifest. Names keep the youvisit-inquiry-{tenant}-{timestamp}
+# stem: a single part becomes e.g. youvisit-inquiry-...txt.gz, several become ...-part-00001.txt.gz, and the manifest
+# is ...manifest.json. The manifest carries Redshift COPY style entries as well as the row count of every part
+def export_parts(output_file, output_buffer, in_aws, key_slug):
+    if output_format not in output_extensions:
+        raise Exception(f'Unsupported OUTPUT_FORMAT {output_format}')
+
+    stem = output_file[:-len('.txt')] if output_file.endswith('.txt') else output_file
+    local_dir = '/tmp/' if in_aws else ''
+    header = list(output_buffer[0]) if output_buffer else []
+    rows = output_buffer[1:]
+    part_rows = output_part_rows if output_part_rows > 0 else max(len(rows), 1)
+    chunks = [rows[i:i + part_rows] for i in range(0, len(rows), part_rows)] or [[]]
+
+    parts = []
+    for number, chunk in enumerate(chunks, start=1):
+        suffix = f"-part-{number:05d}" if len(chunks) > 1 else ""
+        file_name = f"{stem}{suffix}{output_extensions[output_format]}"
+        full_file_path = local_dir + file_name
+        if output_format == 'parquet':
+            write_parquet(full_file_path, header, chunk)
+        else:
+            with gzip.open(full_file_path, mode='wt', encoding='utf-8', newline='', compresslevel=6) if \
+                    output_format == 'gz' else open(full_file_path, mode='w', encoding='utf-8') as part_file:
+                output_writer = csv.writer(part_file, delimiter="|", quotechar='"', quoting=csv.QUOTE_MINIMAL,
+                                           lineterminator='\n')
+                output_writer.writerow(header)
+                output_writer.writerows(chunk)
+        key = f"{key_slug}/{file_name}"
+        parts.append({'key': key, 'file_name': file_name, 'rows': len(chunk),
+                      'bytes': os.path.getsize(full_file_path)})
+        logger.info(f"INFO: part {file_name} -> {len(chunk)} rows")
+        if in_aws == True:
+            upload_to_panto(full_file_path, key)
+
+    bucket_name = os.getenv("PANTO_BUCKET_NAME", "")
+    manifest = {
+        'format': output_format,
+        'columns': header,
+        'total_rows': len(rows),
+        'parts': [{'key': p['key'], 'rows': p['rows'], 'bytes': p['bytes']} for p in parts],
+        'entries': [{'url': f"s3://{bucket_name}/{p['key']}", 'mandatory': True,
+                     'meta': {'content_length': p['bytes']}} for p in parts],
+    }
+    manifest_name = f"{stem}.manifest.json"
+    with open(local_dir + manifest_name, mode='w', encoding='utf-8') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    if in_aws == True:
+        upload_to_panto(local_dir + manifest_name, f"{key_slug}/{manifest_name}")
+    return manifest
+
+# Parquet needs pyarrow, which is only packaged with the functions that export parquet
+def write_parquet(full_file_path, header, rows):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('OUTPUT_FORMAT parquet requires pyarrow to be packaged with the function')
+
+    columns = {}
+    for position, name in enumerate(header):
+        columns[str(name)] = pyarrow.array(
+            [None if row[position] is None or row[position] == "" else str(row[position]) for row in rows],
+            type=pyarrow.string())
+    pyarrow.parquet.write_table(pyarrow.table(columns), full_file_path, compression='snappy')
 
 # Recon - get the count of records that are in scope, determine how many times we need to repeat this
-def recon(url, auth_token, start_date, cur, con, member_sk, create_date_time):
+def recon(run, process_log, start_date):
+
+    import requests
 
     error_encountered = False
     most_recent = start_date
@@ -101,21 +338,22 @@ def recon(url, auth_token, start_date, cur, con, member_sk, create_date_time):
 
     times_to_run = 0
 
-    url += f"?startDate={start_date}&limit={api_record_limit}"
+    url = run.url + f"?startDate={start_date}&limit={api_record_limit}"
 
     logger.info(f"INFO: Running recon on {url}")
 
-    head = {'Authorization': 'Bearer ' + auth_token}
+    head = {'Authorization': 'Bearer ' + run.auth_token}
 
     try:
+        api_rate_limiter.wait()
         response = requests.get(url, headers=head)
+        lambda_metrics.record('HTTP', len(response.content), seconds=response.elapsed.total_seconds())
         logger.info(f"INFO: Response received.")
         logger.debug(f'DEBUG: recon - response: {response}')
     except Exception as em:
-        cur.execute(sql_failed, (str(em), member_sk, create_date_time))
-        con.commit()
+        process_log.failed(run, str(em))
         logger.exception("ERROR: " + str(em))
-        error_encountered = True
+        return times_to_run, True, headers
 
     if response.status_code == 200:
         logger.info("INFO: Response in recon - Status 200 OK")
@@ -138,56 +376,83 @@ def recon(url, auth_token, start_date, cur, con, member_sk, create_date_time):
                 logger.info(f"INFO: recon - how many times to repeat -> {times_to_run}")
             else:
                 error_encountered = True
-                cur.execute(sql_zero_rows, (member_sk, create_date_time))
-                con.commit()
+                process_log.zero_rows(run)
                 logger.info(f"INFO: Zero results returned; terminating.")
                 logger.info(f"INFO: Payload => {return_data}")
-                time.sleep(delay)
         except Exception as em:
-            cur.execute(sql_failed, (str(em), member_sk, create_date_time))
-            con.commit()
+            process_log.failed(run, str(em))
             logger.exception("ERROR: " + str(em))
             error_encountered = True
     else:
-        graceful_death(response, most_recent)
+        graceful_death(run, process_log, response, most_recent)
         error_encountered = True
 
     return times_to_run, error_encountered, headers
 
+# creation_time as a naive UTC datetime, whether it comes from the API (ISO text, with or without T/Z/offset) or from
+# the last_creation_time column (a datetime from psycopg2). None when it cannot be read
+def parse_creation_time(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, datetime.datetime):
+        parsed = value
+    else:
+        try:
+            parsed = datetime.datetime.fromisoformat(str(value).strip().replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return parsed
+
 # Pull the actual data that will be appended to the output buffer and written to Panto's S3
-def pull_data(current_run, times_to_run, url, auth_token, start_date, output_buffer, offset, most_recent, headers):
+def pull_data(run, process_log, current_run, times_to_run, start_date, most_recent, headers, watermark=None):
+    import requests
 
     error_encountered = False
+    watermark = parse_creation_time(watermark)
 
     offset = current_run * api_record_limit
 
-    url += f"?startDate={start_date}&limit={api_record_limit}&offset={offset}"
+    url = run.url + f"?startDate={start_date}&limit={api_record_limit}&offset={offset}"
 
     logger.info(f"INFO: Pulling data, batch {current_run}/{times_to_run} -> {url}")
 
-    head = {'Authorization': 'Bearer ' + auth_token}
+    head = {'Authorization': 'Bearer ' + run.auth_token}
 
     try:
+        api_rate_limiter.wait()
         response = requests.get(url, headers=head)
+        lambda_metrics.record('HTTP', len(response.content), seconds=response.elapsed.total_seconds())
         logger.info(f"INFO: Response received.")
     except Exception as em:
         logger.exception("ERROR: Exception in pull_data - " + str(em))
-        error_encountered = True
+        graceful_death(run, process_log, None, most_recent, str(em))
+        return True, most_recent
 
     if response.status_code == 200:
         logger.info("INFO: Response in pull_data - Status 200 OK")
     else:
-        graceful_death(response, most_recent)
+        graceful_death(run, process_log, response, most_recent)
         error_encountered = True
 
     if error_encountered == False:
         return_data = response.json()
+        # A page only reaches the output buffer (and moves most_recent) once all of it has been read, so a PARTIAL
+        # checkpoint always sits on a page boundary
+        page = []
+        page_most_recent = most_recent
 
         try:
             if len(return_data['resources']) > 0:
                 logger.info(f"INFO: Performing check for line feeds")
                 for record in return_data['resources']['data']:
                     this_dict = dict(record)
+                    # A resumed run skips anything older than the checkpoint watermark - it is already in an earlier file
+                    if watermark is not None:
+                        creation_time = parse_creation_time(this_dict.get('creation_time'))
+                        if creation_time is not None and creation_time < watermark:
+                            continue
                     for key, value in this_dict.items():
                         if value is not None:
                             if '\n' in value:
@@ -198,31 +463,40 @@ def pull_data(current_run, times_to_run, url, auth_token, start_date, output_buf
                                 this_dict[key] = value.replace('\r', ' ')
                     this_row = []
                     try:
-                        most_recent = this_dict['creation_time']
+                        page_most_recent = this_dict['creation_time']
                     except:
-                        most_recent = most_recent
+                        page_most_recent = page_most_recent
                     for header in headers:
                         this_row.append(this_dict.get(header, ""))
-                    output_buffer.append(this_row)
+                    page.append(this_row)
             else:
                 logger.info(f"INFO: Zero results returned; terminating.")
                 logger.info(f"INFO: Payload => {return_data}")
+                graceful_death(run, process_log, None, most_recent, "Zero results returned")
                 error_encountered = True
 
         except TypeError as e:
             logger.error(f"ERROR: Exception in pull_data - " + str(e))
             logger.info(f"INFO: Payload => {return_data}")
+            graceful_death(run, process_log, None, most_recent, str(e))
             error_encountered = True
 
-        time.sleep(delay)
+        if error_encountered == False:
+            run.output_buffer.extend(page)
+            most_recent = page_most_recent
+
     return error_encountered, most_recent
     
+# The connection string only changes with a deploy, so a warm container reads it from SSM once
+@functools.lru_cache(maxsize=1)
+def panto_dsn():
+    return boto.client('ssm').get_parameter(Name='/panto/{}/lambda/db/panto'.format(os.environ["ENVIRONMENT"]), WithDecryption=True)['Parameter']['Value']
+
 def connect_panto():
+    import psycopg2
 
     try:
-            con = psycopg2.connect(
-                    boto.client('ssm').get_parameter(Name='/panto/{}/lambda/db/panto'.format(os.environ["ENVIRONMENT"]), WithDecryption=True)['Parameter']['Value']
-                  )  
+            con = psycopg2.connect(panto_dsn())  
                   
             logger.info('Panto Connection Successful')
             return con, False
@@ -232,29 +506,30 @@ def connect_panto():
             logger.exception("Panto Connection Unsuccessful") 
             return None, True
 
-# A single place to handle an unexpected http code
-def graceful_death(response, most_recent):
+# A single place to handle an unexpected http code, or a page that could not be fetched or read (response is None and
+# error says why). Exports what was pulled and records PARTIAL, or FAILED when nothing was, so the run never ends
+# without a status
+def graceful_death(run, process_log, response, most_recent, error=None):
 
     error_encountered = True
     logger.exception(f"ERROR: Error encountered. Termination imminent.")
     logger.exception(f"ERROR: Most recent record pulled: {most_recent}")
-    logger.exception(f"ERROR: Unexpected status {response.status_code}: {response.content}")
+    if response is not None:
+        logger.exception(f"ERROR: Unexpected status {response.status_code}: {response.content}")
+    else:
+        logger.exception(f"ERROR: {error}")
     observation_timestamp = get_observation_timestamp()
     today = date.today()
-
-    panto_conn, error_encountered = connect_panto()
-    cur = panto_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) 
+    output_buffer = run.output_buffer
 
     if len(output_buffer) > 1:
-        key_slug = f"archive/{tenant_guid}/YouVisit/Inquiry/{today}"
-        csv_export(f"youvisit-inquiry-{tenant_guid}-{observation_timestamp}.txt", output_buffer, in_aws, key_slug)
+        key_slug = f"archive/{run.tenant_guid}/YouVisit/Inquiry/{today}"
+        csv_export(f"youvisit-inquiry-{run.tenant_guid}-{observation_timestamp}.txt", output_buffer, in_aws, key_slug)
         logger.info(f"OUTPUT BUFFER LENGTH: {len(output_buffer)}")
-        cur.execute(sql_partial,(len(output_buffer)-1, most_recent,member_sk, create_date_time))
-        panto_conn.commit()
+        process_log.partial(run, len(output_buffer)-1, most_recent)
     else:
         logger.info(f"OUTPUT BUFFER LENGTH: {len(output_buffer)}")
-        cur.execute(sql_failed, ("No records pulled", member_sk, create_date_time))
-        panto_conn.commit()
+        process_log.failed(run, "No records pulled")
 
 # Observation timestamp format: YYYY-MM-dd_HH-mm-ss-SSS
 def get_observation_timestamp():
@@ -262,86 +537,110 @@ def get_observation_timestamp():
     ts = now.strftime('%Y-%m-%d_%H-%M-%S') + ('-%03d' % (now.microsecond / 10000))
     return ts
 
-def main(event, context):
+# Pull one tenant end to end. Every outcome the API can produce (SUCCESS, PARTIAL, FAILED, zero rows) is queued on the
+# process log here; anything raised out of this function leaves the LAUNCHED row untouched and the message is redelivered
+def run_tenant(run, process_log, start_point):
 
     error_encountered = False
-
-    offset = 0
-    current_run = 0
-    panto_conn, error_encountered = connect_panto()
-    cur = panto_conn.cursor(cursor_factory=psycopg2.extras.DictCursor) 
-    
     today = date.today()
-    # Event/Context Parsing
-    # !- If no date, remove date parameter from URL
-    # ! - Expect the following: PARTNER_ID|AUTH_TOKEN|URL|DATE_LAST_PULLED|PANTO_TENANT_GUID|MEMBER_SK
 
-    # These values can be set for local execution
-    global tenant_guid, member_sk, create_date_time
-    if in_aws:
-        payload = event['Records'][0]['body']
-        payload = payload.replace("('", "").replace("',)", "")
-        partner_id, auth_token, url, create_date_time, tenant_guid, member_sk = payload.split('|')
-        member_sk = member_sk.replace("']","")
-    else:
-        partner_id = 00000
-        auth_token = ""
-        url = ""
-        start_date = ""
-        tenant_guid = ""
-        member_sk = ""
-
-    cur.execute(sql_default_start_time, (member_sk,))
-    prev_success_list = cur.fetchone()
-    if prev_success_list[0] == 0:
-        start_date = "1900-01-01"
-    else:
-       cur.execute(sql_start_time,(member_sk,)) 
-       start_time_list = cur.fetchone()
-       start_date = start_time_list[0]
-        
-    most_recent = start_date
+    start_date, run.committed_offset, watermark = start_point
+    run.offset_start_date = start_date
+    current_run = run.committed_offset // api_record_limit
+
+    most_recent = start_date if watermark is None else watermark
     headers = []
-    global output_buffer
-    output_buffer = []
+    run.output_buffer = []
 
-    times_to_run, error_encountered, headers = \
-        recon(url, auth_token, start_date, cur, panto_conn, member_sk, create_date_time)
-    output_buffer.append(headers)
+    times_to_run, error_encountered, headers = recon(run, process_log, start_date)
+    run.output_buffer.append(headers)
 
     while current_run <= times_to_run and error_encountered == False:
         error_encountered, most_recent = \
-            pull_data(current_run, times_to_run, url, auth_token, start_date, output_buffer,
-                      offset, most_recent, headers)
+            pull_data(run, process_log, current_run, times_to_run, start_date, most_recent, headers, watermark)
         current_run += 1
+        if error_encountered == False:
+            run.committed_offset = current_run * api_record_limit
 
     if error_encountered == False:
-        logger.info(f"INFO: Finished pulling all batches.")
-        logger.info(f"INFO: Output buffer length: {len(output_buffer)}")
-        
+        logger.info(f"INFO: Finished pulling all batches for {run.tenant_guid}.")
+        logger.info(f"INFO: Output buffer length: {len(run.output_buffer)}")
+
         observation_timestamp = get_observation_timestamp()
+        key_slug = f"archive/{run.tenant_guid}/YouVisit/Inquiry/{today}"
+        csv_export(f"youvisit-inquiry-{run.tenant_guid}-{observation_timestamp}.txt", run.output_buffer, in_aws,
+                   key_slug)
+        logger.info(f"OUTPUT BUFFER LENGTH: {len(run.output_buffer)}")
+        process_log.success(run, len(run.output_buffer)-1)
+    else:
+        logger.exception(f"ERROR: Script finished unexpectedly for {run.tenant_guid}")
+        logger.exception(f"ERROR: Output buffer length: {len(run.output_buffer)}")
 
-        if in_aws:
-            key_slug = f"archive/{tenant_guid}/YouVisit/Inquiry/{today}"
-            csv_export(f"youvisit-inquiry-{tenant_guid}-{observation_timestamp}.txt", output_buffer, in_aws, key_slug)
-            logger.info(f"OUTPUT BUFFER LENGTH: {len(output_buffer)}")
-            cur.execute(sql_success,(len(output_buffer)-1,member_sk,create_date_time))
-            panto_conn.commit()           
-            
-        else:
-            logger.info(f"OUTPUT BUFFER LENGTH: {len(output_buffer)}")
-            key_slug = f"archive/{tenant_guid}/YouVisit/Inquiry/{today}"
-            csv_export(f"youvisit-inquiry-{tenant_guid}-{observation_timestamp}.txt", output_buffer, in_aws, key_slug)
-            cur.execute(sql_success,(len(output_buffer)-1,member_sk,create_date_time))
-            panto_conn.commit()     
-            
-        cur.close()
-        panto_conn.close()  
+@lambda_metrics.instrument('you_visit_api')
+def main(event, context):
+
+    # Every record of the SQS batch is one tenant; pull them side by side and report back only the ones that failed
+    # These values can be set for local execution
+    if in_aws:
+        records = event['Records']
     else:
-        logger.exception(f"ERROR: Script finished unexpectedly")
-        logger.exception(f"ERROR: Output buffer length: {len(output_buffer)}")    
+        records = [{'messageId': 'local', 'body': "00000|||||"}]
+
+    runs = {}
+    batch_item_failures = []
+    for record in records:
+        try:
+            runs[record['messageId']] = parse_message(record['body'])
+        except ValueError:
+            logger.exception(f"ERROR: Unable to parse message {record['messageId']}")
+            batch_item_failures.append({'itemIdentifier': record['messageId']})
+
+    panto_conn, error_encountered = connect_panto()
+    if error_encountered:
+        return {'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in records]}
+    process_log = ProcessLog(panto_conn)
+
+    failed = set()
+    try:
+        start_points = process_log.start_points(runs.values())
+
+        # Each tenant's status is written as soon as it finishes; a failed write is retried by the final flush. A
+        # timeout or crash later in the batch still has SQS deliver the whole batch again - the tenants already
+        # written are then no longer LAUNCHED and are skipped rather than pulled and uploaded a second time
+        def pull(message_id):
+            run = runs[message_id]
+            if start_points[run] is None:
+                logger.info(f"INFO: {run.tenant_guid} was already pulled for {run.create_date_time}, skipping the "
+                            f"redelivered message")
+                return
+            run_tenant(run, process_log, start_points[run])
+            try:
+                process_log.flush()
+            except Exception as em:
+                logger.exception("ERROR: Unable to write you_visit_process_log, retrying at the end of the batch - "
+                                 + str(em))
+
+        # A tenant not started because the invocation is running out of time goes back on the queue untouched. A
+        # tenant's pull takes as long as its record count and the shared quota make it, so its time is no latency signal
+        tenants = adaptive_concurrency.AdaptiveConcurrency('you_visit tenants', maximum=max_concurrent_tenants,
+                                                           initial=2, latency_tolerance=None, context=context)
+        outcomes = tenants.map(pull, list(runs))
+        for message_id, (result, em) in zip(list(runs), outcomes):
+            if em is not None:
+                logger.error(f"ERROR: Tenant {runs[message_id].tenant_guid} failed - " + str(em), exc_info=em)
+                failed.add(message_id)
+
+        process_log.flush()
+    except Exception as em:
+        # Every tenant whose status was not written goes back on the queue
+        logger.exception("ERROR: Unable to read or write you_visit_process_log - " + str(em))
+        failed.update(message_id for message_id, run in runs.items() if run not in process_log.written)
+    finally:
+        process_log.close()
 
-    return 0
+    batch_item_failures.extend({'itemIdentifier': message_id} for message_id in failed)
+    logger.info(f"INFO: {len(records) - len(batch_item_failures)}/{len(records)} tenants processed")
+    return {'batchItemFailures': batch_item_failures}
 
 if __name__ == "__main__":
-    main("test", "")
\ No newline at end of file
+    main("test", "")
@@ -0,0 +1,292 @@
+""" Local stand-ins for the YouVisit API and the panto.you_visit_process_log table.
+
+YouVisitSimulator serves synthetic tenants over HTTP the way the real API pages them (startDate/limit/offset,
+resources.data + resources.meta.total), enforces a sliding 100 requests/minute throttle and can inject 429/5xx
+responses. FakePantoDatabase answers the statements you_visit_api runs against the process log so recon, pull_data
+and csv_export can be exercised end to end without Postgres. Used by bench_you_visit.py.
+
+"""
+import collections
+import datetime
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import you_visit_api
+
+# Field set of a full registration; records of a tenant drop some of the optional fields so the header has to be
+# picked dynamically, the same as with real YouVisit payloads
+full_headers = ["id", "experience_name", "experience_id", "firstname", "lastname", "email", "gender", "birthdate",
+                "creation_time", "update_time", "street", "city", "state", "postal", "country", "phone",
+                "graduation_year", "major", "school", "school_ceeb_code", "userkey", "source", "visitor_type",
+                "enroll_year", "enroll_term", "is_cif", "full_registration"]
+required_headers = ["id", "experience_name", "experience_id", "firstname", "lastname", "email", "creation_time"]
+
+
+class TenantSpec:
+    """Shape of one simulated tenant"""
+
+    def __init__(self, tenant_guid, records, key_sets=3, linefeed_rate=0.01, error_rate=0.0,
+                 start_time=datetime.datetime(2021, 1, 1)):
+        self.tenant_guid = tenant_guid
+        self.records = records
+        self.key_sets = key_sets
+        self.linefeed_rate = linefeed_rate
+        self.error_rate = error_rate
+        self.start_time = start_time
+
+
+def make_records(spec, seed=0):
+    """Build the tenant's records, oldest first, with varying key sets and embedded line feeds"""
+
+    rnd = random.Random(f"{spec.tenant_guid}-{seed}")
+    optional = [h for h in full_headers if h not in required_headers]
+    key_sets = []
+    for variant in range(max(1, spec.key_sets)):
+        keep = len(optional) - variant * len(optional) // (2 * max(1, spec.key_sets))
+        key_sets.append(required_headers + optional[:keep])
+
+    records = []
+    for i in range(spec.records):
+        creation_time = spec.start_time + datetime.timedelta(seconds=37 * i)
+        record = {}
+        for key in key_sets[i % len(key_sets)]:
+            record[key] = f"{key}-{i}"
+        record['id'] = str(i)
+        record['creation_time'] = creation_time.strftime('%Y-%m-%d %H:%M:%S')
+        record['update_time'] = record['creation_time']
+        if rnd.random() < spec.linefeed_rate:
+            record['street'] = f"{i} Main St\r\nApt {i % 40}"
+        records.append(record)
+    return records
+
+
+class _Throttle:
+    """Sliding one minute window shared by every tenant of the simulator"""
+
+    def __init__(self, requests_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.calls = collections.deque()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            now = time.monotonic()
+            while self.calls and now - self.calls[0] >= 60:
+                self.calls.popleft()
+            if len(self.calls) >= self.requests_per_minute:
+                return False
+            self.calls.append(now)
+            return True
+
+
+class YouVisitSimulator:
+    """HTTP stand-in for the YouVisit leads API; use as a context manager"""
+
+    def __init__(self, tenants, requests_per_minute=100, error_statuses=(429, 500, 503), seed=0):
+        self.tenants = {spec.tenant_guid: (spec, make_records(spec, seed)) for spec in tenants}
+        self.throttle = _Throttle(requests_per_minute)
+        self.error_statuses = error_statuses
+        self.random = random.Random(seed)
+        self.stats_lock = threading.Lock()
+        self.api_calls = collections.Counter()
+        self.statuses = collections.Counter()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.thread = None
+
+    def url_for(self, tenant_guid):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}/tenants/{tenant_guid}/leads"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def respond(self, path, query):
+        """Return (status, body) for one request"""
+
+        parts = path.strip('/').split('/')
+        if len(parts) != 3 or parts[0] != 'tenants' or parts[1] not in self.tenants:
+            return 404, {'error': 'unknown tenant'}
+        spec, records = self.tenants[parts[1]]
+
+        if not self.throttle.allow():
+            return 429, {'error': 'Too Many Requests'}
+        with self.stats_lock:
+            injected = self.random.random() < spec.error_rate
+            status = self.random.choice(self.error_statuses) if injected else 200
+        if status != 200:
+            return status, {'error': 'injected failure'}
+
+        start_date = query.get('startDate', ['1900-01-01'])[0]
+        limit = int(query.get('limit', ['500'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+        in_scope = [r for r in records if r['creation_time'] >= str(start_date)]
+        page = in_scope[offset:offset + limit]
+        return 200, {'resources': {'data': page, 'meta': {'total': len(in_scope), 'offset': offset,
+                                                          'limit': limit}}}
+
+    def _handler(self):
+        simulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                status, body = simulator.respond(url.path, parse_qs(url.query))
+                parts = url.path.strip('/').split('/')
+                with simulator.stats_lock:
+                    simulator.api_calls[parts[1] if len(parts) > 1 else url.path] += 1
+                    simulator.statuses[status] += 1
+                payload = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                if status == 429:
+                    self.send_header('Retry-After', '60')
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class FakePantoDatabase:
+    """In-memory panto.you_visit_process_log answering the statements in you_visit_api"""
+
+    def __init__(self):
+        self.rows = []
+        self.lock = threading.Lock()
+        self.statements = collections.Counter()
+
+    def launch(self, member_sk, create_date_time):
+        """Insert the LAUNCHED row the SQS publisher would have written"""
+
+        with self.lock:
+            self.rows.append({'mbr_sk': str(member_sk), 'create_start_date': str(create_date_time),
+                              'status_indicator': 'LAUNCHED: Message passed on to SQS Queue',
+                              'no_of_rows_in_file': None, 'error_decription': None, 'offset_start_date': None,
+                              'last_offset': None, 'last_creation_time': None})
+
+    def status_of(self, member_sk, create_date_time):
+        for row in self.rows:
+            if row['mbr_sk'] == str(member_sk) and row['create_start_date'] == str(create_date_time):
+                return row
+        return None
+
+    def connect(self):
+        return _FakeConnection(self)
+
+    def execute(self, sql, params):
+        """Apply one statement; returns the result rows of a SELECT"""
+
+        with self.lock:
+            if isinstance(sql, bytes):
+                return self._bulk_status(sql.decode('utf-8'))
+            self.statements[sql] += 1
+            if sql == you_visit_api.sql_start_points:
+                results = []
+                for position, (member_sk, create_date_time) in enumerate(zip(*params), start=1):
+                    own = self.status_of(member_sk, create_date_time)
+                    launched = own is not None and own['status_indicator'].startswith('LAUNCHED')
+                    rows = self._finished(member_sk)
+                    if rows:
+                        row = max(rows, key=lambda r: r['create_start_date'])
+                        results.append((position, launched, row['status_indicator'], row['offset_start_date'],
+                                        row['last_offset'], row['last_creation_time'],
+                                        max(r['create_start_date'][:10] for r in rows)))
+                    else:
+                        results.append((position, launched, None, None, None, None, None))
+                return results
+            raise Exception(f'FakePantoDatabase does not understand the statement {sql}')
+
+    def _bulk_status(self, statement):
+        # execute_values hands over the statement with the VALUES list already rendered; _FakeCursor.mogrify renders
+        # each row as JSON so the rows can be read back here
+        pre, post = you_visit_api.sql_status_bulk.split('%s')
+        if not (statement.startswith(pre) and statement.endswith(post)):
+            raise Exception(f'FakePantoDatabase does not understand the statement {statement}')
+        self.statements[you_visit_api.sql_status_bulk] += 1
+        for values in json.loads('[' + statement[len(pre):len(statement) - len(post)] + ']'):
+            status_indicator, no_of_rows_in_file, error_decription, offset_start_date, last_offset, \
+                last_creation_time, member_sk, create_date_time = values
+            updates = {'status_indicator': status_indicator, 'no_of_rows_in_file': no_of_rows_in_file}
+            if last_creation_time is not None:
+                # Like Postgres' ::timestamp cast, which drops any UTC offset rather than converting
+                last_creation_time = str(datetime.datetime.fromisoformat(
+                    last_creation_time.replace('Z', '+00:00')).replace(tzinfo=None))
+            for column, value in (('error_decription', error_decription), ('offset_start_date', offset_start_date),
+                                  ('last_offset', last_offset), ('last_creation_time', last_creation_time)):
+                if value is not None:
+                    updates[column] = value
+            self._update(member_sk, create_date_time, **updates)
+        return []
+
+    def _finished(self, member_sk):
+        return [r for r in self.rows if r['mbr_sk'] == str(member_sk)
+                and r['status_indicator'] in ('SUCCESS', 'PARTIAL')]
+
+    def _update(self, member_sk, create_date_time, **values):
+        for row in self.rows:
+            if row['mbr_sk'] == str(member_sk) and row['create_start_date'] == str(create_date_time) \
+                    and row['status_indicator'] == 'LAUNCHED: Message passed on to SQS Queue':
+                row.update(values)
+
+
+class _FakeConnection:
+
+    encoding = 'UTF8'
+
+    def __init__(self, database):
+        self.database = database
+
+    def cursor(self, cursor_factory=None):
+        return _FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.database = connection.database
+        self.results = []
+
+    def mogrify(self, template, args):
+        return json.dumps(list(args), default=str).encode('utf-8')
+
+    def execute(self, sql, params=None):
+        self.results = list(self.database.execute(sql, params or ()))
+
+    def fetchone(self):
+        return self.results.pop(0) if self.results else None
+
+    def fetchall(self):
+        results, self.results = self.results, []
+        return results
+
+    def close(self):
+        pass